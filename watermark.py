@@ -1,15 +1,12 @@
 import os
 import argparse
-from PIL import Image, ImageDraw, ImageFont
-import exifread
+from PIL import Image, ImageDraw
+import watermark_fonts
+from watermark_metadata import get_metadata_cache
 
 def get_exif_date(image_path):
-    date = None
-    with open(image_path, 'rb') as f:
-        tags = exifread.process_file(f)
-        if 'EXIF DateTimeOriginal' in tags:
-            date_str = str(tags['EXIF DateTimeOriginal'])
-            date = date_str.split(' ')[0].replace(':', '-')
+    metadata = get_metadata_cache().get_info(image_path)
+    date = metadata['date'] if metadata else None
     if not date:
         import datetime
         date = datetime.date.today().strftime("%Y-%m-%d")
@@ -18,10 +15,7 @@ def get_exif_date(image_path):
 def add_watermark(image_path, text, output_path, font_size, color, position):
     image = Image.open(image_path)
     draw = ImageDraw.Draw(image)
-    try:
-        font = ImageFont.truetype("arial.ttf", font_size)
-    except IOError:
-        font = ImageFont.load_default()
+    font = watermark_fonts.get_font('Arial', font_size)
 
     text_width, text_height = draw.textbbox((0, 0), text, font=font)[2:]
     width, height = image.size
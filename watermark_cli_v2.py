@@ -4,18 +4,537 @@ Image Watermarker CLI v2.0
 Enhanced command-line version with advanced features
 """
 
+import io
 import os
+import math
 import sys
 import json
+import hashlib
 import argparse
+import multiprocessing
+import queue
+import posixpath
+import tarfile
+import tempfile
+import threading
+import zipfile
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from multiprocessing import resource_tracker, shared_memory
 from pathlib import Path
-from PIL import Image, ImageDraw, ImageFont
-import exifread
+from PIL import GifImagePlugin, Image, ImageChops, ImageColor, ImageDraw, JpegImagePlugin
+import watermark_fonts
+import watermark_tiff
+from watermark_metadata import get_metadata_cache, image_metadata, read_exif_date
 from datetime import datetime
 
+# EXIF Orientation 标签
+EXIF_ORIENTATION = 0x0112
+
+class WatermarkStamp:
+    """预渲染的水印图章"""
+    
+    def __init__(self, image, offset, text_size, translucent, text, font, layers):
+        self.image = image  # RGBA图章
+        self.offset = offset  # 图章左上角相对文本绘制原点的偏移
+        self.text_size = text_size  # 用于定位的文本尺寸
+        self.translucent = translucent  # 是否需要按透明度合成
+        # 图章无法直接贴入的图片模式按图层直接绘制文本
+        self.text = text
+        self.font = font
+        self.layers = layers
+        # 按EXIF方向变换后的图章，见 oriented
+        self.orientations = {}
+    
+    def draw_text(self, draw, x, y):
+        """在 (x, y) 处按图层直接绘制文本"""
+        for offsets, fill in self.layers:
+            for dx, dy in offsets:
+                draw.text((x + dx, y + dy), self.text, fill=fill, font=self.font)
+    
+    def oriented(self, orientation):
+        """按EXIF方向变换到像素存储方向的图章，每个方向只变换一次
+
+        变换后的图章偏移为 (0, 0)，只能按透明度合成，不能直接绘制文本。
+        """
+        stamp = self.orientations.get(orientation)
+        if stamp is None:
+            image = self.image.transpose(STORED_ORIENTATION[orientation][0])
+            stamp = WatermarkStamp(image, (0, 0), image.size, True, self.text, self.font, None)
+            self.orientations[orientation] = stamp
+        return stamp
+
+# EXIF方向 -> (从显示方向变换到存储方向的操作, 显示坐标 (x, y) 到存储坐标的映射)，w、h 为显示尺寸
+STORED_ORIENTATION = {
+    2: (Image.Transpose.FLIP_LEFT_RIGHT, lambda x, y, w, h: (w - x, y)),
+    3: (Image.Transpose.ROTATE_180, lambda x, y, w, h: (w - x, h - y)),
+    4: (Image.Transpose.FLIP_TOP_BOTTOM, lambda x, y, w, h: (x, h - y)),
+    5: (Image.Transpose.TRANSPOSE, lambda x, y, w, h: (y, x)),
+    6: (Image.Transpose.ROTATE_90, lambda x, y, w, h: (y, w - x)),
+    7: (Image.Transpose.TRANSVERSE, lambda x, y, w, h: (h - y, w - x)),
+    8: (Image.Transpose.ROTATE_270, lambda x, y, w, h: (h - y, x)),
+}
+
+class StampCache:
+    """水印图章的LRU缓存"""
+    
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self._stamps = OrderedDict()
+        # 流水线模式下多个线程共用同一个缓存
+        self.lock = threading.RLock()
+    
+    def get(self, key):
+        with self.lock:
+            stamp = self._stamps.get(key)
+            if stamp is not None:
+                self._stamps.move_to_end(key)
+            return stamp
+    
+    def put(self, key, stamp):
+        with self.lock:
+            self._stamps[key] = stamp
+            self._stamps.move_to_end(key)
+            while len(self._stamps) > self.maxsize:
+                self._stamps.popitem(last=False)
+    
+    def clear(self):
+        with self.lock:
+            self._stamps.clear()
+
+class BatchManifest:
+    """增量处理清单，记录每个输入文件的大小、修改时间、内容哈希和处理时的设置
+
+    清单保存在各输出目录下的 .watermark_manifest.json 中。处理过程中新的记录逐行追加到
+    .watermark_manifest.log，每次只写入新增的记录；save 时合并到清单并删除日志，
+    中断后下次加载时从日志中恢复。
+    """
+    
+    filename = '.watermark_manifest.json'
+    log_filename = '.watermark_manifest.log'
+    
+    def __init__(self, settings_hash, content_hash=False, save_interval=50):
+        self.settings_hash = settings_hash
+        self.content_hash = content_hash
+        self.save_interval = save_interval
+        self._manifests = {}  # 输出目录 -> {输入路径: 记录}
+        self._dirty = set()
+        self._pending = {}  # 输出目录 -> 尚未追加到日志的记录行
+        self._unsaved = 0
+    
+    def _load(self, directory):
+        if directory not in self._manifests:
+            entries = {}
+            try:
+                with open(os.path.join(directory, self.filename), 'r', encoding='utf-8') as f:
+                    entries = json.load(f).get('entries', {})
+            except:
+                pass
+            
+            # 上次中断时未合并的记录
+            try:
+                with open(os.path.join(directory, self.log_filename), 'r', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            # 中断时可能留下不完整的最后一行
+                            continue
+                        entries[entry.pop('input')] = entry
+                self._dirty.add(directory)
+            except OSError:
+                pass
+            self._manifests[directory] = entries
+        return self._manifests[directory]
+    
+    def file_hash(self, input_path):
+        """计算文件内容哈希"""
+        digest = hashlib.blake2b(digest_size=16)
+        with open(input_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+    
+    def is_up_to_date(self, input_path, output_path):
+        """输入文件和设置都未变化且输出文件存在时返回 True"""
+        entries = self._load(os.path.dirname(os.path.abspath(output_path)))
+        entry = entries.get(os.path.abspath(input_path))
+        if not entry or entry.get('settings') != self.settings_hash:
+            return False
+        if not os.path.exists(output_path):
+            return False
+        
+        st = os.stat(input_path)
+        if entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns:
+            return True
+        
+        # 文件时间变化但内容未变（如同步工具重新写入）时也跳过，并更新记录
+        if self.content_hash and entry.get('hash') and entry['size'] == st.st_size:
+            if self.file_hash(input_path) == entry['hash']:
+                self.record(input_path, output_path, entry['hash'])
+                return True
+        
+        return False
+    
+    def record(self, input_path, output_path, file_hash=None):
+        """记录处理完成的文件"""
+        directory = os.path.dirname(os.path.abspath(output_path))
+        st = os.stat(input_path)
+        if self.content_hash and file_hash is None:
+            file_hash = self.file_hash(input_path)
+        
+        entry = {
+            'size': st.st_size,
+            'mtime_ns': st.st_mtime_ns,
+            'hash': file_hash,
+            'settings': self.settings_hash,
+            'output': os.path.abspath(output_path)
+        }
+        self._load(directory)[os.path.abspath(input_path)] = entry
+        self._dirty.add(directory)
+        self._pending.setdefault(directory, []).append(
+            json.dumps(dict(entry, input=os.path.abspath(input_path)), ensure_ascii=False))
+        
+        self._unsaved += 1
+        if self._unsaved >= self.save_interval:
+            self.flush()
+    
+    def flush(self):
+        """将新增的记录追加到各目录的日志"""
+        for directory, lines in self._pending.items():
+            with open(os.path.join(directory, self.log_filename), 'a', encoding='utf-8') as f:
+                f.write('\n'.join(lines) + '\n')
+        self._pending.clear()
+        self._unsaved = 0
+    
+    def save(self):
+        """将有变化的清单整体写入一次，并删除已合并的日志"""
+        for directory in self._dirty:
+            manifest_file = os.path.join(directory, self.filename)
+            tmp_file = manifest_file + '.tmp'
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump({'entries': self._manifests[directory]}, f, ensure_ascii=False)
+            os.replace(tmp_file, manifest_file)
+            try:
+                os.remove(os.path.join(directory, self.log_filename))
+            except OSError:
+                pass
+        self._dirty.clear()
+        self._pending.clear()
+        self._unsaved = 0
+
+class BufferReader(io.RawIOBase):
+    """只读的内存文件对象，直接从 memoryview 等缓冲区读取，不复制整个缓冲区"""
+    
+    def __init__(self, buffer):
+        self.view = memoryview(buffer).cast('B')
+        self.position = 0
+    
+    def readable(self):
+        return True
+    
+    def seekable(self):
+        return True
+    
+    def readinto(self, b):
+        size = max(0, min(len(b), len(self.view) - self.position))
+        b[:size] = self.view[self.position:self.position + size]
+        self.position += size
+        return size
+    
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        if offset < 0:
+            raise ValueError("negative seek position")
+        self.position = offset
+        return self.position
+    
+    def tell(self):
+        return self.position
+    
+    def close(self):
+        self.view.release()
+        super().close()
+
+class FrameSequence(Image.Image):
+    """按需生成各帧的多帧图片
+
+    保存多帧图片时每次 seek 才调用 get_frame(帧序号) 生成该帧，不需要同时保留所有帧。
+    各帧的时长记录在 durations 中。
+    像素数据、模式和尺寸都取自当前帧，不改写 Image 的内部属性。
+    """
+    
+    def __init__(self, n_frames, get_frame):
+        super().__init__()
+        self.n_frames = n_frames
+        self.is_animated = n_frames > 1
+        self.get_frame = get_frame
+        self.durations = FrameDurations(self)
+        self.frame = None
+        self.current = None
+        self.seek(0)
+    
+    @property
+    def im(self):
+        return self.current.im
+    
+    @property
+    def mode(self):
+        return self.current.mode
+    
+    @property
+    def size(self):
+        return self.current.size
+    
+    def seek(self, frame):
+        if not 0 <= frame < self.n_frames:
+            raise EOFError("no more frames")
+        if frame == self.frame:
+            return
+        image = self.get_frame(frame)
+        image.load()
+        self.current = image
+        self.palette = image.palette
+        self.info = dict(image.info)
+        # APNG的时长可能是小数，AVIF只接受整数毫秒
+        self.durations.record(frame, round(image.info.get('duration', 0)))
+        self.frame = frame
+    
+    def tell(self):
+        return self.frame
+
+class FrameDurations(list):
+    """FrameSequence 各帧的时长，保存时在 seek 到该帧之后读取"""
+    
+    def __init__(self, frames):
+        super().__init__()
+        self.frames = frames
+        self.values = {}
+    
+    def record(self, frame, duration):
+        self.values[frame] = duration
+    
+    def __getitem__(self, frame):
+        return self.values.get(frame, 0)
+    
+    def __len__(self):
+        return self.frames.n_frames
+
+def display_size(size, orientation):
+    """按EXIF方向显示时的尺寸，方向 5-8 宽高互换；反过来由显示尺寸得到存储尺寸也相同"""
+    return (size[1], size[0]) if orientation in (5, 6, 7, 8) else tuple(size)
+
+# 按多帧处理的原图格式
+FRAME_SOURCE_FORMATS = ('GIF', 'PNG', 'TIFF', 'WEBP')
+# 按JPEG处理的原图格式；MPO 是带预览图的JPEG（相机和手机照片常见），只处理第一帧主图
+JPEG_FORMATS = ('JPEG', 'MPO')
+
+def is_multiframe(image):
+    """是否为多帧图片（GIF动画、APNG、多页TIFF等），MPO 的预览图不算"""
+    return image.format in FRAME_SOURCE_FORMATS and getattr(image, 'n_frames', 1) > 1
+
+def open_buffer(data):
+    """将图片数据包装为文件对象，bytes 直接使用，其他缓冲区对象不复制"""
+    if isinstance(data, bytes):
+        return io.BytesIO(data)
+    return BufferReader(data)
+
+ARCHIVE_SUFFIXES = ('.zip', '.tar')
+
+def is_archive(path):
+    """是否为支持的压缩包（按扩展名判断）"""
+    return Path(path).suffix.lower() in ARCHIVE_SUFFIXES
+
+class ArchiveReader:
+    """按需读取zip/tar包中的图片，不解压到磁盘"""
+    
+    def __init__(self, path, supported_formats):
+        self.path = Path(path)
+        self.members = {}
+        if self.path.suffix.lower() == '.zip':
+            self.archive = zipfile.ZipFile(self.path)
+            members = [(info.filename, info) for info in self.archive.infolist() if not info.is_dir()]
+        else:
+            self.archive = tarfile.open(self.path)
+            # 只读取各成员的头信息，数据在读取时才从包中取出
+            members = [(member.name, member) for member in self.archive.getmembers() if member.isfile()]
+        
+        for name, member in members:
+            if self._is_safe(name) and Path(name).suffix.lower() in supported_formats:
+                self.members[name] = member
+    
+    def _is_safe(self, name):
+        """忽略绝对路径和包含 .. 的成员，输出到目录时不会写到输出目录之外"""
+        parts = name.replace('\\', '/').split('/')
+        return not name.startswith(('/', '\\')) and '..' not in parts and ':' not in parts[0]
+    
+    def names(self):
+        """包中的图片成员名，按名称排序"""
+        return sorted(self.members)
+    
+    def read(self, name):
+        """读取一个成员的数据"""
+        if isinstance(self.archive, zipfile.ZipFile):
+            return self.archive.read(self.members[name])
+        return self.archive.extractfile(self.members[name]).read()
+    
+    def close(self):
+        self.archive.close()
+
+class ArchiveWriter:
+    """将输出写入zip/tar包，先写入同目录下的临时文件，完成后再替换目标文件"""
+    
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd, self.tmp_path = tempfile.mkstemp(prefix=f".{self.path.name}.", suffix='.tmp', dir=self.path.parent)
+        self.file = os.fdopen(fd, 'wb')
+        if self.path.suffix.lower() == '.zip':
+            # 图片已经压缩过，不再压缩
+            self.archive = zipfile.ZipFile(self.file, 'w', zipfile.ZIP_STORED)
+        else:
+            self.archive = tarfile.open(fileobj=self.file, mode='w')
+    
+    def write(self, name, data):
+        """写入一个文件"""
+        if isinstance(self.archive, zipfile.ZipFile):
+            info = zipfile.ZipInfo(name, datetime.now().timetuple()[:6])
+            self.archive.writestr(info, data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = int(datetime.now().timestamp())
+            info.mode = 0o644
+            self.archive.addfile(info, io.BytesIO(data))
+    
+    def close(self, finished=True):
+        """关闭输出包；未完成时删除临时文件，不替换目标文件"""
+        try:
+            self.archive.close()
+            self.file.close()
+            if finished:
+                os.replace(self.tmp_path, self.path)
+        finally:
+            if os.path.exists(self.tmp_path):
+                os.remove(self.tmp_path)
+
+def sync_directory(path):
+    """将目录中的重命名等修改刷到磁盘；Windows 不支持对目录 fsync，跳过"""
+    if os.name == 'nt':
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class BatchJournal:
+    """批处理检查点日志，逐行追加已完成的图片，用于中断后继续处理"""
+    
+    def __init__(self, path):
+        self.path = Path(path)
+        self.completed = {}  # 输入路径 -> 输出路径
+        self._file = None
+    
+    def open(self, resume=False):
+        """打开日志；resume=True 时读取已完成的记录并继续追加，否则重新开始"""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if resume:
+            self.completed = self.load()
+        self._file = open(self.path, 'a' if resume else 'w', encoding='utf-8')
+    
+    def load(self):
+        """读取日志中已完成的记录"""
+        completed = {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # 中断时可能留下不完整的最后一行
+                        continue
+                    completed[entry['input']] = entry['output']
+        except OSError:
+            pass
+        return completed
+    
+    def record(self, input_path, output_path):
+        """追加一条完成记录并立即写入磁盘"""
+        self._file.write(json.dumps({'input': input_path, 'output': output_path}, ensure_ascii=False) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+    
+    def close(self, finished=False):
+        """关闭日志；批处理全部完成时删除日志"""
+        if self._file:
+            self._file.close()
+            self._file = None
+        if finished:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
 class WatermarkProcessor:
+    # 影响图章渲染结果的设置项
+    stamp_setting_keys = ('font_size', 'font_family', 'bold', 'italic', 'color',
+                          'opacity', 'shadow', 'outline', 'rotation')
+    # 从RGBA转换时会做抖动的图片模式
+    dither_modes = ('1',)
+    # 可以直接贴入不透明图章的图片模式
+    stamp_paste_modes = ('RGB', 'L', 'RGBA')
+    # 按透明度直接混合透明图章的图片模式，不需要转换为RGBA
+    blend_modes = ('L', 'CMYK')
+    # 带透明通道、直接合成透明图章的图片模式
+    alpha_modes = ('RGBA', 'LA')
+    # 缩放时整数倍缩小后保留的目标尺寸倍数
+    reducing_gap = 2
+    # 按比例缩小水印时的最小字号
+    min_font_size = 8
+    # 未指定输出目录时，输出到图片所在目录下的该子目录
+    default_output_dirname = 'watermarked'
+    # jpeg_quality 为 'keep' 但源图片不是JPEG（或输出不是JPEG）时使用的质量
+    keep_fallback_quality = 95
+    # 输出格式对应的扩展名
+    output_extensions = {'JPEG': '.jpg', 'PNG': '.png', 'WEBP': '.webp', 'AVIF': '.avif', 'GIF': '.gif', 'TIFF': '.tif'}
+    # 可以保存多帧的输出格式；输出格式为JPEG时，多帧图片沿用原图格式
+    frame_formats = ('PNG', 'WEBP', 'AVIF')
+    # 可以写入EXIF的输出格式
+    exif_formats = ('JPEG', 'PNG', 'WEBP', 'AVIF', 'TIFF')
+    source_frame_formats = FRAME_SOURCE_FORMATS
+    # 编码预设：在编码耗时和文件大小之间取舍，balanced 与 Pillow 默认参数一致
+    encoder_presets = {
+        'fast': {
+            'JPEG': {},
+            'PNG': {'compress_level': 1},
+            'WEBP': {'method': 0},
+            'AVIF': {'speed': 10}
+        },
+        'balanced': {
+            'JPEG': {},
+            'PNG': {'compress_level': 6},
+            'WEBP': {'method': 4},
+            'AVIF': {'speed': 6}
+        },
+        'small': {
+            'JPEG': {'optimize': True},
+            'PNG': {'compress_level': 9, 'optimize': True},
+            'WEBP': {'method': 6},
+            'AVIF': {'speed': 2}
+        }
+    }
+    # 限制文件大小时用于估算的样本：size_sample_grid x size_sample_grid 个小块
+    size_sample_grid = 4
+    size_sample_tile = 64
+    # 按估算选择质量的完整编码次数，超过后改为二分查找
+    size_guided_attempts = 2
+    
     def __init__(self):
-        self.supported_formats = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.tif'}
+        self.supported_formats = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.tif', '.gif'}
         self.default_settings = {
             'text': '',
             'font_size': 36,
@@ -26,6 +545,7 @@ class WatermarkProcessor:
             'x_offset': 10,
             'y_offset': 10,
             'rotation': 0,
+            'tile_spacing': 100,  # position 为 tiled 时图章之间的间距
             'bold': False,
             'italic': False,
             'shadow': False,
@@ -37,50 +557,115 @@ class WatermarkProcessor:
             'naming_option': 'suffix',  # 'original', 'prefix', 'suffix'
             'custom_prefix': 'wm_',
             'custom_suffix': '_watermarked',
-            'output_format': 'JPEG',
-            'jpeg_quality': 95,
+            'output_format': 'JPEG',  # 'JPEG', 'PNG', 'WEBP', 'AVIF'
+            'encoder_preset': 'balanced',  # 'fast', 'balanced', 'small'
+            'jpeg_quality': 95,  # 'keep' 表示沿用源JPEG的量化表和色度抽样
             'resize_enabled': False,
             'resize_width': 0,
             'resize_height': 0,
-            'resize_percent': 100
+            'resize_percent': 100,
+            'output_widths': [],  # 多尺寸输出的宽度列表
+            'max_bytes': 0,  # 输出文件大小上限（字节），0 表示不限制
+            'tiled_tiff': False  # 分块TIFF只重写与水印重叠的图块，输出仍为TIFF
         }
         
         self.watermark_settings = self.default_settings.copy()
+        # 多模板输出时加载的模板，每个模板输出到单独的子目录
+        self.templates = []
+        self._template_processors = None
+        # 模板名，由 template_processors 为每个模板的处理器设置
+        self.name = None
+        self.stamp_cache = StampCache()
+        # 平铺水印的图案较大，只缓存少量
+        self.pattern_cache = StampCache(maxsize=4)
+        self.metadata_cache = get_metadata_cache()
     
     def get_exif_date(self, image_path):
         """从EXIF数据获取日期"""
-        try:
-            with open(image_path, 'rb') as f:
-                tags = exifread.process_file(f)
-                if 'EXIF DateTimeOriginal' in tags:
-                    date_str = str(tags['EXIF DateTimeOriginal'])
-                    return date_str.split(' ')[0].replace(':', '-')
-        except:
-            pass
+        metadata = self.metadata_cache.get_info(image_path)
+        if metadata and metadata['date']:
+            return metadata['date']
+        
+        # 如果没有EXIF日期，使用当前日期
+        return datetime.now().strftime("%Y-%m-%d")
+    
+    def get_image_date(self, image, data=None, image_path=None):
+        """从已打开的图片获取EXIF日期，data 为图片文件内容
+
+        提供 image_path 时先查元数据缓存，命中则不再解析EXIF。
+        """
+        metadata = self.metadata_cache.lookup(image_path) if image_path else None
+        if metadata is None:
+            # Pillow无法解析时用exifread解析同一份数据，不再重新打开文件
+            date = read_exif_date(image, open_buffer(data) if data is not None else None)
+            metadata = image_metadata(image, date)
+            if image_path:
+                self.metadata_cache.store(image_path, metadata)
+        
+        if metadata['date']:
+            return metadata['date']
         
         # 如果没有EXIF日期，使用当前日期
         return datetime.now().strftime("%Y-%m-%d")
     
+    def read_file(self, input_path):
+        """一次性读取文件内容"""
+        with open(input_path, 'rb') as f:
+            return f.read()
+    
     def find_images(self, path):
         """查找图片文件"""
-        images = []
+        return sorted(self.iter_images(path))
+    
+    def iter_images(self, path, sort=False):
+        """单次遍历目录，逐个产出图片文件路径
+
+        扩展名不区分大小写；sort=True 时每个目录内按名称顺序产出。
+        输出目录（未指定时为各级的 watermarked 子目录）不会被遍历。
+        """
         path = Path(path)
         
         if path.is_file():
             if path.suffix.lower() in self.supported_formats:
-                images.append(str(path))
-        elif path.is_dir():
-            for ext in self.supported_formats:
-                images.extend(path.glob(f"**/*{ext}"))
-                images.extend(path.glob(f"**/*{ext.upper()}"))
-            images = [str(img) for img in images]
-        
-        return sorted(images)
-    
-    def calculate_watermark_position(self, img_width, img_height, text_width, text_height):
-        """计算水印位置"""
-        margin_x = self.watermark_settings['x_offset']
-        margin_y = self.watermark_settings['y_offset']
+                yield str(path)
+            return
+        
+        if not path.is_dir():
+            return
+        
+        # 跳过输出目录，避免处理过程中遍历到刚写出的文件
+        output_dir = self.export_settings.get('output_dir')
+        skip_dir = os.path.realpath(output_dir) if output_dir else None
+        
+        pending = [str(path)]
+        while pending:
+            directory = pending.pop()
+            try:
+                with os.scandir(directory) as it:
+                    entries = sorted(it, key=lambda e: e.name) if sort else it
+                    subdirs = []
+                    for entry in entries:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                if skip_dir is None:
+                                    if entry.name != self.default_output_dirname:
+                                        subdirs.append(entry.path)
+                                elif os.path.realpath(entry.path) != skip_dir:
+                                    subdirs.append(entry.path)
+                            elif os.path.splitext(entry.name)[1].lower() in self.supported_formats and entry.is_file():
+                                yield entry.path
+                        except OSError:
+                            continue
+            except OSError:
+                continue
+            
+            # 子目录逆序入栈，保证按顺序出栈
+            pending.extend(reversed(subdirs))
+    
+    def calculate_watermark_position(self, img_width, img_height, text_width, text_height, scale=1.0):
+        """计算水印位置，scale 为边距的缩放比例"""
+        margin_x = round(self.watermark_settings['x_offset'] * scale)
+        margin_y = round(self.watermark_settings['y_offset'] * scale)
         position = self.watermark_settings['position']
         
         position_map = {
@@ -97,112 +682,356 @@ class WatermarkProcessor:
         
         return position_map.get(position, position_map['bottom_right'])
     
-    def add_watermark_to_image(self, image, text=None):
-        """为图片添加水印"""
+    def add_watermark_to_image(self, image, text=None, in_place=False, scale=1.0, orientation=1, keep_palette=False):
+        """为图片添加水印，scale 为字号和边距的缩放比例
+
+        orientation 为EXIF方向：按显示方向计算水印位置，再将图章和位置变换到像素的存储方向，
+        不需要旋转整张图片。
+        keep_palette=True 时调色板图片不增加颜色（GIF各帧共用原调色板）。
+        """
         if text is None:
             text = self.watermark_settings['text']
         
         if not text:
             return image
         
-        # 创建图片副本
-        img_with_watermark = image.copy()
+        # 获取预渲染的水印图章
+        font_size = None
+        if scale != 1.0:
+            font_size = max(self.min_font_size, round(self.watermark_settings['font_size'] * scale))
+        stamp = self.get_stamp(text, font_size)
         
-        # 如果需要透明度，转换为RGBA
-        if self.watermark_settings['opacity'] < 100:
-            if img_with_watermark.mode != 'RGBA':
-                img_with_watermark = img_with_watermark.convert('RGBA')
-            
-            # 创建透明图层
-            overlay = Image.new('RGBA', img_with_watermark.size, (0, 0, 0, 0))
-            draw = ImageDraw.Draw(overlay)
-        else:
-            draw = ImageDraw.Draw(img_with_watermark)
+        if self.watermark_settings['position'] == 'tiled':
+            pattern = self.get_pattern(text, font_size, image.size, (0, 0) + image.size, scale, orientation)
+            return self.apply_pattern(image, pattern, in_place)
+        
+        stamp, x, y = self.place_stamp(stamp, image.size, scale, orientation)
+        return self.apply_stamp(image, stamp, x, y, in_place, keep_palette)
+    
+    def place_stamp(self, stamp, size, scale=1.0, orientation=1):
+        """计算图章在尺寸为 size 的图片上的位置，返回 (图章, x, y)
+
+        位置按EXIF方向的显示方向计算，再与图章一起变换到像素的存储方向。
+        """
+        img_width, img_height = display_size(size, orientation)
+        text_width, text_height = stamp.text_size
+        x, y = self.calculate_watermark_position(img_width, img_height, text_width, text_height, scale)
         
-        # 设置字体
-        font = self.get_font()
+        if orientation not in STORED_ORIENTATION:
+            return stamp, x, y
+        
+        # 图章在显示方向上的范围映射到存储方向
+        left, top = x + stamp.offset[0], y + stamp.offset[1]
+        mapping = STORED_ORIENTATION[orientation][1]
+        corners = [mapping(left, top, img_width, img_height),
+                   mapping(left + stamp.image.width, top + stamp.image.height, img_width, img_height)]
+        return stamp.oriented(orientation), min(c[0] for c in corners), min(c[1] for c in corners)
+    
+    def get_orientation(self, image):
+        """读取EXIF方向，没有或无法解析时返回 1"""
+        if image.format == 'TIFF':
+            # Pillow读取TIFF时已按方向标签旋转像素
+            return 1
+        try:
+            orientation = image.getexif().get(EXIF_ORIENTATION, 1)
+        except Exception:
+            return 1
+        return orientation if orientation in STORED_ORIENTATION else 1
+    
+    def stamp_key(self, text, font_size=None):
+        """图章缓存的键，包含文本、字号和全部样式设置"""
+        return (text, font_size) + tuple(self.watermark_settings.get(k) for k in self.stamp_setting_keys)
+    
+    def get_stamp(self, text, font_size=None):
+        """获取水印图章，相同文本和样式只渲染一次；font_size 用于覆盖设置中的字号"""
+        key = self.stamp_key(text, font_size)
+        stamp = self.stamp_cache.get(key)
+        if stamp is None:
+            # 字体对象不能被多个线程同时使用，渲染时持有缓存锁
+            with self.stamp_cache.lock:
+                stamp = self.stamp_cache.get(key)
+                if stamp is None:
+                    stamp = self.render_stamp(text, font_size)
+                    self.stamp_cache.put(key, stamp)
+        return stamp
+    
+    def render_stamp(self, text, font_size=None):
+        """将带样式的文本（描边、阴影、透明度）渲染为RGBA图章"""
+        font = self.get_font(font_size)
         
         # 获取文本尺寸
-        bbox = draw.textbbox((0, 0), text, font=font)
-        text_width = bbox[2] - bbox[0]
-        text_height = bbox[3] - bbox[1]
+        bbox = font.getbbox(text)
+        text_size = (bbox[2] - bbox[0], bbox[3] - bbox[1])
         
-        # 计算位置
-        img_width, img_height = image.size
-        x, y = self.calculate_watermark_position(img_width, img_height, text_width, text_height)
+        # 图章覆盖文本及描边(±1)、阴影(+2)的范围，offset为相对绘制原点的偏移
+        left, top = bbox[0] - 1, bbox[1] - 1
+        size = (bbox[2] + 2 - left, bbox[3] + 2 - top)
+        origin = (-left, -top)
         
         # 设置颜色和透明度
         color = self.watermark_settings['color']
-        if self.watermark_settings['opacity'] < 100:
-            # 转换颜色为RGBA
-            if color.startswith('#'):
-                color = tuple(int(color[i:i+2], 16) for i in (1, 3, 5))
+        translucent = self.watermark_settings['opacity'] < 100
+        if translucent:
             alpha = int(255 * self.watermark_settings['opacity'] / 100)
-            color = color + (alpha,)
+            color = ImageColor.getrgb(color)[:3] + (alpha,)
+            outline_color, shadow_color = (0, 0, 0, alpha), (0, 0, 0, alpha // 2)
+        else:
+            outline_color, shadow_color = 'black', 'gray'
         
-        # 绘制文本
+        # 按描边、阴影、主文本的顺序组织图层
+        layers = []
         if self.watermark_settings['outline']:
-            # 绘制描边
-            outline_color = (0, 0, 0, alpha) if self.watermark_settings['opacity'] < 100 else 'black'
-            for dx in [-1, 0, 1]:
-                for dy in [-1, 0, 1]:
-                    if dx != 0 or dy != 0:
-                        draw.text((x + dx, y + dy), text, fill=outline_color, font=font)
-        
+            offsets = [(dx, dy) for dx in [-1, 0, 1] for dy in [-1, 0, 1] if dx != 0 or dy != 0]
+            layers.append((offsets, outline_color))
         if self.watermark_settings['shadow']:
-            # 绘制阴影
-            shadow_color = (0, 0, 0, alpha // 2) if self.watermark_settings['opacity'] < 100 else 'gray'
-            draw.text((x + 2, y + 2), text, fill=shadow_color, font=font)
+            layers.append(([(2, 2)], shadow_color))
+        layers.append(([(0, 0)], color))
+        
+        stamp = WatermarkStamp(None, (left, top), text_size, translucent, text, font, layers)
+        tile = Image.new('RGBA', size, (0, 0, 0, 0))
+        if translucent:
+            # 与透明图层的绘制方式一致，直接在透明图章上绘制
+            stamp.draw_text(ImageDraw.Draw(tile), origin[0], origin[1])
+        else:
+            # 不透明时每个图层先绘制成蒙版，再依次叠加到图章上
+            for offsets, fill in layers:
+                mask = Image.new('L', size, 0)
+                draw = ImageDraw.Draw(mask)
+                for dx, dy in offsets:
+                    draw.text((origin[0] + dx, origin[1] + dy), text, fill=255, font=font)
+                layer = Image.new('RGBA', size, ImageColor.getrgb(fill)[:3] + (255,))
+                layer.putalpha(mask)
+                tile = Image.alpha_composite(tile, layer)
+        
+        stamp.image = tile
+        
+        rotation = (self.watermark_settings.get('rotation') or 0) % 360
+        if rotation:
+            stamp = self.rotate_stamp(stamp, rotation, (origin[0] + bbox[0], origin[1] + bbox[1]))
+        return stamp
+    
+    def rotate_stamp(self, stamp, angle, text_origin):
+        """将图章逆时针旋转 angle 度，text_origin 为文本在图章中的左上角
+
+        旋转后文本的外接矩形作为定位用的文本尺寸，偏移为图章左上角相对该矩形的位置。
+        旋转后的图章只能按透明度合成。
+        """
+        # 按预乘透明度旋转，避免透明像素的颜色在边缘形成暗边
+        image = stamp.image.convert('RGBa').rotate(angle, Image.Resampling.BICUBIC, expand=True).convert('RGBA')
+        
+        # 文本四个角绕图章中心旋转后的位置（图片坐标系y轴向下，逆时针旋转）
+        cos, sin = math.cos(math.radians(angle)), math.sin(math.radians(angle))
+        center_x, center_y = stamp.image.width / 2, stamp.image.height / 2
+        text_width, text_height = stamp.text_size
+        xs, ys = [], []
+        for dx in (0, text_width):
+            for dy in (0, text_height):
+                px, py = text_origin[0] + dx - center_x, text_origin[1] + dy - center_y
+                xs.append(px * cos + py * sin + image.width / 2)
+                ys.append(-px * sin + py * cos + image.height / 2)
+        
+        left, top = math.floor(min(xs)), math.floor(min(ys))
+        text_size = (math.ceil(max(xs)) - left, math.ceil(max(ys)) - top)
+        return WatermarkStamp(image, (-left, -top), text_size, True, stamp.text, stamp.font, None)
+    
+    def get_pattern(self, text, font_size, size, box, scale=1.0, orientation=1):
+        """获取平铺水印图案中 box (left, top, right, bottom) 范围的部分，size 为图片尺寸
+
+        图章排成交错的网格（相邻两行错开半个间隔），网格以图片中心为基准；
+        图案按 (图章, 方向, 区域大小, 区域在网格中的相位) 缓存，相同尺寸的图片直接复用。
+        """
+        stamp = self.get_stamp(text, font_size)
+        if orientation in STORED_ORIENTATION:
+            stamp = stamp.oriented(orientation)
         
-        # 绘制主文本
-        draw.text((x, y), text, fill=color, font=font)
+        spacing = max(0, round((self.watermark_settings.get('tile_spacing') or 0) * scale))
+        stamp_width, stamp_height = stamp.image.size
+        period_x, period_y = stamp_width + spacing, stamp_height + spacing
         
-        # 如果使用了透明度，合并图层
-        if self.watermark_settings['opacity'] < 100:
-            img_with_watermark = Image.alpha_composite(img_with_watermark, overlay)
-            if image.mode != 'RGBA':
-                img_with_watermark = img_with_watermark.convert(image.mode)
+        # 区域左上角相对网格原点（居中的图章）的位置，网格每两行重复一次
+        left = box[0] - (size[0] - stamp_width) // 2
+        top = box[1] - (size[1] - stamp_height) // 2
+        width, height = box[2] - box[0], box[3] - box[1]
+        key = self.stamp_key(text, font_size) + (orientation, spacing, width, height,
+                                                  left % period_x, top % (2 * period_y))
         
+        pattern = self.pattern_cache.get(key)
+        if pattern is None:
+            pattern = self.render_pattern(stamp, left, top, width, height, period_x, period_y)
+            self.pattern_cache.put(key, pattern)
+        return pattern
+    
+    def render_pattern(self, stamp, left, top, width, height, period_x, period_y):
+        """渲染平铺图案：先将图章按间隔复制成一行，再按行错开贴入"""
+        stamp_height = stamp.image.height
+        
+        # 每次复制已填充的部分，图章只贴一次
+        strip = Image.new('RGBA', (width + period_x, stamp_height), (0, 0, 0, 0))
+        strip.paste(stamp.image, (0, 0))
+        filled = period_x
+        while filled < strip.width:
+            strip.paste(strip.crop((0, 0, filled, stamp_height)), (filled, 0))
+            filled *= 2
+        
+        pattern = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+        for row in range(-(-(top - stamp_height + 1) // period_y), (top + height - 1) // period_y + 1):
+            shift = (row % 2) * (period_x // 2)
+            start = (left - shift) % period_x
+            pattern.paste(strip.crop((start, 0, start + width, stamp_height)), (0, row * period_y - top))
+        return pattern
+    
+    def apply_pattern(self, image, pattern, in_place=False):
+        """一次合成整张平铺图案"""
+        img_with_watermark = image if in_place else image.copy()
+        mode = img_with_watermark.mode
+        if mode in self.alpha_modes:
+            img_with_watermark.alpha_composite(pattern.convert(mode))
+        elif mode == 'RGB' or mode in self.blend_modes:
+            # RGB图片可以直接贴入RGBA图案，其他模式先转换图案
+            img_with_watermark.paste(pattern if mode == 'RGB' else pattern.convert(mode), (0, 0), pattern)
+        else:
+            stamp = WatermarkStamp(pattern, (0, 0), pattern.size, True, None, None, None)
+            img_with_watermark = self.apply_stamp(img_with_watermark, stamp, 0, 0, in_place=True)
         return img_with_watermark
     
-    def get_font(self):
-        """获取字体"""
-        font_size = self.watermark_settings['font_size']
+    def apply_stamp(self, image, stamp, x, y, in_place=False, keep_palette=False):
+        """将水印图章合成到图片的 (x, y) 位置
+
+        只在图章覆盖的区域内进行合成；in_place=True 时直接修改传入的图片。
+        keep_palette=True 时调色板图片只映射到原有颜色，不增加新颜色。
+        """
+        img_with_watermark = image if in_place else image.copy()
+        box = (x + stamp.offset[0], y + stamp.offset[1])
         
-        # 尝试加载系统字体
-        font_paths = [
-            "/System/Library/Fonts/Arial.ttf",  # macOS
-            "/System/Library/Fonts/Helvetica.ttc",  # macOS
-            "C:/Windows/Fonts/arial.ttf",  # Windows
-            "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",  # Linux
-        ]
+        if stamp.translucent and image.mode in self.dither_modes:
+            # 转换这些模式会做抖动，逐区域转换与整图转换结果不同，仍整图合成
+            return self.composite_full(img_with_watermark, stamp, box)
         
-        for font_path in font_paths:
-            try:
-                font = ImageFont.truetype(font_path, font_size)
-                return font
-            except:
-                continue
+        if not stamp.translucent and image.mode not in self.stamp_paste_modes:
+            if image.mode != 'P' or (not keep_palette and self.palette_has_room(image, stamp)):
+                # 其他模式直接绘制文本，保证颜色按图片模式解析
+                stamp.draw_text(ImageDraw.Draw(img_with_watermark), x, y)
+                return img_with_watermark
+        
+        tile, dest = self.clip_stamp(stamp, box, img_with_watermark.size)
+        if tile is None:
+            return img_with_watermark
         
-        # 如果都失败了，使用默认字体
+        mode = img_with_watermark.mode
+        if mode in self.alpha_modes:
+            # 带透明通道的图片需要同时合成透明通道
+            img_with_watermark.alpha_composite(tile.convert(mode), dest)
+        elif stamp.translucent and mode in self.blend_modes:
+            # 图章转换为图片的模式，按透明度直接混合
+            img_with_watermark.paste(tile.convert(mode), dest, tile)
+        elif mode == 'P':
+            # 只把图章覆盖的像素映射到原调色板中的颜色
+            self.composite_palette(img_with_watermark, tile, dest)
+        elif stamp.translucent:
+            # 只裁剪水印覆盖的区域，合成后再贴回原图
+            region_box = dest + (dest[0] + tile.width, dest[1] + tile.height)
+            region = img_with_watermark.crop(region_box).convert('RGBA')
+            region.alpha_composite(tile)
+            img_with_watermark.paste(region.convert(image.mode), dest)
+        else:
+            img_with_watermark.paste(tile, dest, tile)
+        
+        return img_with_watermark
+    
+    def palette_has_room(self, image, stamp):
+        """直接绘制文本时，各图层的颜色能否加入调色板图片的调色板（调色板满时不能）"""
+        palette = image.palette.copy()
         try:
-            return ImageFont.load_default()
-        except:
-            return ImageFont.load_default()
+            for offsets, fill in stamp.layers:
+                color = ImageColor.getcolor(fill, image.mode) if isinstance(fill, str) else fill
+                palette.getcolor(color, image)
+        except ValueError:
+            return False
+        return True
+    
+    def composite_palette(self, image, tile, dest):
+        """在调色板图片上合成透明图章
+
+        只有图章覆盖的像素映射到原调色板中最接近的颜色，其余像素保留原来的序号，
+        调色板和透明色不变。
+        """
+        region = image.crop(dest + (dest[0] + tile.width, dest[1] + tile.height))
+        composited = region.convert('RGBA')
+        composited.alpha_composite(tile)
+        
+        palette = image.getpalette('RGB')
+        palette_image = Image.new('P', (1, 1))
+        palette_image.putpalette(palette)
+        mapped = composited.convert('RGB').quantize(palette=palette_image, dither=Image.Dither.NONE)
+        
+        # 合成后不透明的像素不能使用透明色，改用与透明色最接近的其他颜色
+        transparency = image.info.get('transparency')
+        if isinstance(transparency, int):
+            transparent = {transparency}
+        elif isinstance(transparency, bytes):
+            transparent = {i for i, a in enumerate(transparency) if a < 128}
+        else:
+            transparent = set()
+        colors = [tuple(palette[i:i + 3]) for i in range(0, len(palette), 3)]
+        opaque = [i for i in range(len(colors)) if i not in transparent]
+        if transparent and opaque:
+            indices = Image.frombytes('L', mapped.size, mapped.tobytes())
+            used = {index for count, index in indices.getcolors(256)}
+            for index in transparent & used:
+                target = colors[index] if index < len(colors) else (0, 0, 0)
+                replacement = min(opaque, key=lambda i: sum((a - b) ** 2 for a, b in zip(colors[i], target)))
+                mapped.paste(replacement, mask=indices.point(lambda i: 255 if i == index else 0))
+        
+        # 只替换图章覆盖、且合成后不透明的像素
+        covered = tile.getchannel('A').point(lambda a: 255 if a else 0)
+        visible = composited.getchannel('A').point(lambda a: 255 if a >= 128 else 0)
+        image.paste(mapped, dest, ImageChops.multiply(covered, visible))
     
-    def generate_output_path(self, input_path, output_dir=None):
-        """生成输出文件路径"""
+    def composite_full(self, image, stamp, box):
+        """整图合成透明水印"""
+        img_with_watermark = image.convert('RGBA')
+        
+        # 创建透明图层并放入图章
+        overlay = Image.new('RGBA', img_with_watermark.size, (0, 0, 0, 0))
+        overlay.paste(stamp.image, box)
+        
+        # 合并图层
+        img_with_watermark = Image.alpha_composite(img_with_watermark, overlay)
+        return img_with_watermark.convert(image.mode)
+    
+    def clip_stamp(self, stamp, box, image_size):
+        """将图章裁剪到图片范围内，返回裁剪后的图章和目标位置"""
+        left, top = max(box[0], 0), max(box[1], 0)
+        right = min(box[0] + stamp.image.width, image_size[0])
+        bottom = min(box[1] + stamp.image.height, image_size[1])
+        if left >= right or top >= bottom:
+            return None, None
+        
+        tile = stamp.image.crop((left - box[0], top - box[1], right - box[0], bottom - box[1]))
+        return tile, (left, top)
+    
+    def get_font(self, font_size=None):
+        """获取字体"""
+        return watermark_fonts.get_font(self.watermark_settings['font_family'],
+                                        font_size or self.watermark_settings['font_size'],
+                                        self.watermark_settings['bold'],
+                                        self.watermark_settings['italic'])
+    
+    def generate_output_path(self, input_path, output_dir=None, variant=None, output_format=None):
+        """生成输出文件路径，variant 为附加在文件名末尾的区分标记（如输出宽度）"""
         input_path = Path(input_path)
         
         if output_dir:
             output_dir = Path(output_dir)
         else:
-            output_dir = input_path.parent / "watermarked"
+            output_dir = input_path.parent / self.default_output_dirname
         
         output_dir.mkdir(parents=True, exist_ok=True)
         
-        # 根据命名选项生成新文件名
-        name = input_path.stem
+        return output_dir / self.output_filename(input_path.stem, variant, output_format)
+    
+    def output_filename(self, name, variant=None, output_format=None):
+        """根据命名选项和输出格式生成输出文件名，output_format 默认为导出设置中的格式"""
         if self.export_settings['naming_option'] == 'original':
             new_name = name
         elif self.export_settings['naming_option'] == 'prefix':
@@ -210,66 +1039,1289 @@ class WatermarkProcessor:
         else:  # suffix
             new_name = name + self.export_settings['custom_suffix']
         
+        if variant:
+            new_name = f"{new_name}_{variant}"
+        
         # 根据输出格式设置扩展名
-        if self.export_settings['output_format'] == 'JPEG':
-            new_ext = '.jpg'
-        else:
-            new_ext = '.png'
+        new_ext = self.output_extensions.get(output_format or self.export_settings['output_format'], '.png')
         
-        return output_dir / (new_name + new_ext)
+        return new_name + new_ext
+    
+    def source_kind(self, fp, input_path=None):
+        """读取图片文件头，返回 (图片格式, 是否多帧, 是否按图块处理)，供 output_format_for 使用
+
+        fp 为文件路径或文件对象；提供 input_path 时检查是否按分块TIFF处理。
+        """
+        tiled = input_path is not None and self.get_tile_layout(input_path) is not None
+        try:
+            with Image.open(fp) as img:
+                return img.format, is_multiframe(img), tiled
+        except Exception:
+            return None, False, tiled
+    
+    def output_format_for(self, kind=None):
+        """确定输出格式，所有输出路径和包内名称的扩展名都由此决定
+
+        kind 为 source_kind 的结果：分块TIFF输出TIFF，多帧图片见 frame_output_format，
+        其余使用导出设置中的格式。
+        """
+        image_format, multiframe, tiled = kind or (None, False, False)
+        if tiled:
+            return 'TIFF'
+        if multiframe:
+            return self.frame_output_format(image_format)
+        return self.export_settings['output_format']
     
     def process_image(self, input_path, output_path=None, auto_date=False):
         """处理单张图片"""
+        return self.process_image_result(input_path, output_path, auto_date)['output']
+    
+    def process_image_result(self, input_path, output_path=None, auto_date=False):
+        """处理单张图片，返回结果记录"""
         try:
-            # 加载图片
-            with Image.open(input_path) as img:
-                # 如果启用自动日期，获取EXIF日期
-                if auto_date:
-                    date = self.get_exif_date(input_path)
-                    watermarked_img = self.add_watermark_to_image(img, date)
+            layout = self.get_tile_layout(input_path)
+            if layout is not None:
+                return self.process_tiled_tiff(input_path, layout, output_path, auto_date)
+            
+            # 加载图片，文件只读取一次，EXIF日期和解码共用同一份数据
+            data = self.read_file(input_path)
+            outputs = self.render_outputs(input_path, data, output_path, auto_date)
+            
+            # 保存图片
+            for path, encoded, quality in outputs:
+                self.write_output(encoded, path)
+            
+            return self.output_result(input_path, outputs)
+        
+        except Exception as e:
+            raise Exception(f"处理图片 {input_path} 失败: {e}")
+    
+    def get_tile_layout(self, input_path):
+        """启用 tiled_tiff 时获取分块TIFF的图块布局，不适用时返回 None"""
+        if not self.export_settings.get('tiled_tiff') or self.templates:
+            return None
+        if Path(input_path).suffix.lower() not in ('.tif', '.tiff'):
+            return None
+        return watermark_tiff.read_tile_layout(input_path)
+    
+    def process_tiled_tiff(self, input_path, layout, output_path=None, auto_date=False):
+        """为分块TIFF添加水印，返回结果记录
+
+        不解码整张图片：只读取、合成并重新编码与水印重叠的图块，其余图块原样复制，
+        内存占用只与图块大小有关。输出为与输入相同格式的TIFF，不做缩放。
+        """
+        text = self.get_exif_date(input_path) if auto_date else self.watermark_settings['text']
+        if output_path:
+            output_path = Path(output_path)
+            output_path.parent.mkdir(parents=True, exist_ok=True)
+        else:
+            output_path = self.output_paths(input_path, kind=('TIFF', False, True))[0][0]
+        
+        indices = []
+        tiled = self.watermark_settings['position'] == 'tiled'
+        if text and tiled:
+            # 平铺水印覆盖所有图块，每个图块只取对应部分的图案
+            indices = list(range(len(layout.offsets)))
+        elif text:
+            stamp, x, y = self.place_stamp(self.get_stamp(text), layout.size, orientation=layout.orientation)
+            left, top = x + stamp.offset[0], y + stamp.offset[1]
+            indices = layout.tiles_in_box((left, top, left + stamp.image.width, top + stamp.image.height))
+        
+        def modify(index, tile):
+            tile_x, tile_y = layout.tile_origin(index)
+            if tiled:
+                box = (tile_x, tile_y, tile_x + tile.width, tile_y + tile.height)
+                pattern = self.get_pattern(text, None, layout.size, box, orientation=layout.orientation)
+                return self.apply_pattern(tile, pattern, in_place=True)
+            return self.apply_stamp(tile, stamp, x - tile_x, y - tile_y, in_place=True)
+        
+        # 与 write_output 相同，先写临时文件并刷到磁盘，再替换
+        tmp_path = output_path.with_name(f".{output_path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            watermark_tiff.rewrite_tiles(input_path, tmp_path, layout, indices, modify)
+            os.replace(tmp_path, output_path)
+            sync_directory(output_path.parent)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        
+        return {'input': input_path, 'output': str(output_path), 'success': True}
+    
+    def output_result(self, input_path, outputs):
+        """生成处理成功的结果记录，限制文件大小时记录各输出选择的质量
+
+        质量降到 1 仍超出大小上限时，结果中 over_budget 为 True。
+        """
+        result = {'input': input_path, 'output': str(outputs[0][0]), 'success': True}
+        qualities = [quality for path, encoded, quality in outputs]
+        if any(quality is not None for quality in qualities):
+            result['quality'] = qualities[0]
+            result['qualities'] = qualities
+        max_bytes = self.export_settings.get('max_bytes') or 0
+        if max_bytes and any(len(encoded) > max_bytes for path, encoded, quality in outputs):
+            result['over_budget'] = True
+        return result
+    
+    def render_bytes(self, data, text=None, auto_date=False):
+        """在内存中处理图片，不读写文件，返回 [(输出名称, 编码后的数据, 选择的质量)]
+
+        data 为图片文件内容，可以是 bytes 或 memoryview 等支持缓冲区协议的对象（不会复制）。
+        输出名称为多尺寸输出的宽度和模板名，只有一个输出时为 None。
+        """
+        return self.render_outputs(None, data, auto_date=auto_date, text=text)
+    
+    def watermark_bytes(self, data, text=None, auto_date=False):
+        """在内存中为图片添加水印，返回编码后的数据；有多个输出时返回第一个"""
+        return self.render_bytes(data, text, auto_date)[0][1]
+    
+    def render_outputs(self, input_path, data, output_path=None, auto_date=False, text=None):
+        """解码、添加水印并编码，返回 [(输出路径, 编码后的数据, 选择的质量)]
+
+        设置了多个输出宽度或加载了多个模板时，每张图片只解码一次，生成所有输出。
+        input_path 为 None 时不生成输出路径，见 render_bytes。
+        """
+        with Image.open(open_buffer(data)) as img:
+            # 如果启用自动日期，获取EXIF日期
+            date = None
+            if text is None and auto_date and self.needs_date():
+                date = self.get_image_date(img, data, input_path)
+            
+            source = self.get_source_encoding(img)
+            
+            if not self.templates:
+                return self.render_decoded(input_path, img, text if text is not None else date,
+                                           output_path, in_place=True, source=source)
+            
+            # 所有模板共用同一份解码结果
+            img.load()
+            outputs = []
+            for template in self.template_processors():
+                template_output = template.template_output_path(output_path)
+                template_text = text if text is not None else template.date_text(date)
+                outputs.extend(template.render_decoded(input_path, img, template_text, template_output, source=source))
+            return outputs
+    
+    def needs_date(self):
+        """启用自动日期时是否需要读取EXIF日期：模板自带文本时不使用日期"""
+        if self.templates:
+            return any(template.needs_date() for template in self.template_processors())
+        return self.name is None or not self.watermark_settings['text']
+    
+    def date_text(self, date):
+        """自动日期对应的水印文本，模板自带文本时返回 None（使用模板文本）"""
+        return date if self.needs_date() else None
+    
+    def render_decoded(self, input_path, image, text=None, output_path=None, in_place=False, source=None):
+        """为已解码的图片添加水印并编码，返回 [(输出路径, 编码后的数据, 选择的质量)]
+
+        in_place=False 时不修改传入的图片，供多个模板共用。
+        source 为 get_source_encoding 记录的源JPEG编码参数。
+        """
+        if input_path is None:
+            targets = self.output_variants()
+        else:
+            targets = self.output_paths(input_path, output_path, (image.format, is_multiframe(image), False))
+        
+        if is_multiframe(image):
+            return self.render_frames(image, targets, text)
+        
+        if self.export_settings.get('output_widths'):
+            return self.render_derivatives(image, targets, text, source)
+        
+        # 先缩放，再按输出分辨率添加水印
+        resized_img = self.resize_for_export(image, self.source_orientation(source))
+        in_place = in_place or resized_img is not image
+        watermarked_img = self.add_watermark_to_image(resized_img, text, in_place=in_place,
+                                                      orientation=self.source_orientation(source))
+        
+        return [(targets[0][0],) + self.encode_output(watermarked_img, source)]
+    
+    def render_derivatives(self, image, targets, text=None, source=None):
+        """从一次解码生成多个宽度的输出，targets 为 [(输出路径, 输出宽度)]
+
+        从大到小逐级缩放，每个尺寸由上一个尺寸缩小得到；
+        最大尺寸使用设置的字号，其余尺寸的水印按宽度等比缩小。
+        宽度指按EXIF方向显示时的宽度。
+        """
+        orientation = self.source_orientation(source)
+        source_width, source_height = display_size(image.size, orientation)
+        outputs = []
+        current = image
+        largest = None
+        
+        for path, width in targets:
+            width = min(width, source_width)
+            size = display_size((width, max(1, round(source_height * width / source_width))), orientation)
+            if largest is None:
+                largest = width
+                if image.format in JPEG_FORMATS:
+                    # 只按最大输出尺寸解码
+                    image.draft(image.mode, size)
+            
+            current = self.downscale(current, size)
+            watermarked = self.add_watermark_to_image(current, text, scale=width / largest, orientation=orientation)
+            outputs.append((path,) + self.encode_output(watermarked, source))
+        
+        return outputs
+    
+    def render_frames(self, image, targets, text=None):
+        """为多帧图片（GIF动画、APNG、多页TIFF）的每一帧添加水印，返回 [(输出路径, 编码后的数据, None)]
+
+        逐帧解码、添加水印和编码，不同时保留所有帧；水印图章由缓存提供，所有帧共用。
+        保留各帧的时长、GIF的处置方式和调色板。
+        """
+        output_format = self.frame_output_format(image.format)
+        info = {'loop': image.info.get('loop'), 'compression': image.info.get('compression')}
+        largest = max((width for path, width in targets if width), default=None)
+        
+        # GIF各帧映射回第一帧的调色板，只重映射图章覆盖的像素
+        source_palette = None
+        if output_format == 'GIF':
+            image.seek(0)
+            if image.mode == 'P':
+                transparency = image.info.get('transparency')
+                source_palette = (self.extend_palette(image.getpalette('RGB'), text),
+                                  transparency if isinstance(transparency, int) else None)
+        
+        outputs = []
+        for path, width in targets:
+            def render_frame(index, width=width):
+                image.seek(index)
+                # 多页TIFF各页尺寸可能不同，按当前帧的尺寸计算；与 render_derivatives 一样不放大
+                frame_width, frame_height = image.size
+                scale = 1.0
+                if width:
+                    target = min(width, frame_width)
+                    size = (target, max(1, round(frame_height * target / frame_width)))
+                    scale = target / min(largest, frame_width)
                 else:
-                    watermarked_img = self.add_watermark_to_image(img)
-                
-                # 生成输出路径
-                if not output_path:
-                    output_path = self.generate_output_path(input_path, self.export_settings.get('output_dir'))
+                    size = self.get_export_size(frame_width, frame_height)
                 
-                # 确保输出目录存在
-                output_path = Path(output_path)
-                output_path.parent.mkdir(parents=True, exist_ok=True)
-                
-                # 保存图片
-                if self.export_settings['output_format'] == 'JPEG':
-                    if watermarked_img.mode == 'RGBA':
-                        watermarked_img = watermarked_img.convert('RGB')
-                    watermarked_img.save(output_path, 'JPEG', quality=self.export_settings['jpeg_quality'])
+                # 解码器会在上一帧的基础上合成下一帧，不能直接修改
+                frame = image
+                if source_palette and image.mode != 'P':
+                    # Pillow从第二帧起（或遇到局部调色板时）解码为RGB
+                    frame = self.map_to_source_palette(image, *source_palette) or image
+                frame = self.downscale(frame, size) if size else frame
+                if frame is image:
+                    frame = image.copy()
+                if source_palette and frame.mode == 'P':
+                    frame.putpalette(source_palette[0])
+                if output_format in ('WEBP', 'AVIF') and frame.mode == 'P':
+                    # 真彩色输出在RGB/RGBA下合成，不受原调色板限制；模式与Pillow解码后续帧时一致
+                    frame = frame.convert('RGBA' if 'transparency' in frame.info else 'RGB')
+                frame = self.add_watermark_to_image(frame, text, in_place=True, scale=scale,
+                                                    keep_palette=source_palette is not None)
+                frame.info = dict(image.info, disposal=getattr(image, 'disposal_method', 0))
+                if source_palette and source_palette[1] is not None and frame.mode == 'P':
+                    # Pillow只在第一帧的 info 中给出透明色
+                    frame.info['transparency'] = source_palette[1]
+                return frame
+            
+            outputs.append((path, self.encode_frames(image.n_frames, render_frame, output_format, info), None))
+        
+        return outputs
+    
+    def frame_output_format(self, image_format):
+        """多帧图片的输出格式，image_format 为原图格式
+
+        多页TIFF各页尺寸可能不同、没有时长，不是动画，始终输出为多页TIFF。
+        """
+        output_format = self.export_settings['output_format']
+        if image_format == 'TIFF':
+            return 'TIFF'
+        if output_format in self.frame_formats:
+            return output_format
+        return image_format if image_format in self.source_frame_formats else 'PNG'
+    
+    def encode_frames(self, n_frames, render_frame, output_format, info):
+        """逐帧编码多帧图片，render_frame(帧序号) 返回添加水印后的帧"""
+        if output_format == 'GIF':
+            return self.encode_gif_frames(n_frames, render_frame, info.get('loop'))
+        
+        frames = FrameSequence(n_frames, render_frame)
+        preset = self.encoder_presets.get(self.export_settings.get('encoder_preset'), self.encoder_presets['balanced'])
+        options = dict(preset.get(output_format, {}))
+        
+        if output_format == 'TIFF':
+            if info.get('compression') in ('tiff_lzw', 'tiff_adobe_deflate', 'packbits'):
+                options['compression'] = info['compression']
+        else:
+            options['duration'] = frames.durations
+            if info.get('loop') is not None:
+                options['loop'] = info['loop']
+        
+        if output_format in ('WEBP', 'AVIF'):
+            quality = self.export_settings['jpeg_quality']
+            options['quality'] = self.keep_fallback_quality if quality == 'keep' else quality
+        elif output_format == 'PNG':
+            # 每帧都是合成后的完整画面，直接替换上一帧
+            options.update(disposal=0, blend=0)
+        
+        return self.save_to_bytes(frames, output_format, dict(options, save_all=True))
+    
+    def encode_gif_frames(self, n_frames, render_frame, loop=None):
+        """逐帧写出GIF动画
+
+        第一帧的调色板作为全局调色板，之后颜色相同的帧直接复用，
+        不同时才写入局部调色板；每帧编码后立即写出，内存占用不随帧数增长。
+        """
+        buffer = io.BytesIO()
+        global_palette = None
+        
+        for index in range(n_frames):
+            frame = render_frame(index)
+            mapped, transparency = self.map_to_palette(frame)
+            palette = mapped.getpalette()
+            params = {'duration': frame.info.get('duration', 0), 'disposal': frame.info.get('disposal', 0)}
+            if transparency is not None:
+                params['transparency'] = transparency
+            
+            if index == 0:
+                header_info = {'background': frame.info.get('background', 0), 'optimize': False}
+                if loop is not None:
+                    header_info['loop'] = loop
+                header, _ = GifImagePlugin.getheader(mapped, info=header_info)
+                buffer.write(b''.join(header))
+                global_palette = palette
+            elif palette != global_palette:
+                params['include_color_table'] = True
+            
+            for chunk in GifImagePlugin.getdata(mapped, (0, 0), **params):
+                buffer.write(chunk)
+        
+        buffer.write(b';')
+        return buffer.getvalue()
+    
+    def extend_palette(self, palette, text=None):
+        """调色板有空位时加入水印各图层的颜色（与直接绘制文本时一致），返回新的调色板
+
+        GIF各帧共用扩展后的调色板，原有颜色的序号不变。
+        """
+        text = text if text is not None else self.watermark_settings['text']
+        if not text:
+            return palette
+        
+        palette = list(palette)
+        entries = {tuple(palette[i:i + 3]) for i in range(0, len(palette), 3)}
+        for offsets, fill in self.get_stamp(text).layers:
+            color = tuple(ImageColor.getrgb(fill)[:3] if isinstance(fill, str) else fill[:3])
+            if color not in entries and len(palette) < 768:
+                palette.extend(color)
+                entries.add(color)
+        return palette
+    
+    def map_to_source_palette(self, frame, palette, transparency):
+        """将解码为RGB/RGBA的GIF帧无损映射回原调色板，返回P模式图片
+
+        帧中有原调色板以外的颜色、或有透明像素但原图没有透明色时返回 None。
+        """
+        colors = frame.convert('RGBA').getcolors(1024)
+        if colors is None:
+            return None
+        
+        entries = [tuple(palette[i:i + 3]) for i in range(0, len(palette), 3)]
+        opaque = {color[:3] for count, color in colors if color[3] >= 128}
+        if not opaque <= set(entries):
+            return None
+        has_transparent = any(color[3] < 128 for count, color in colors)
+        if has_transparent and transparency is None:
+            return None
+        
+        # 透明色的序号换成帧中没有的颜色，避免不透明像素被映射到透明色
+        lookup = list(palette)
+        if transparency is not None and transparency < len(entries):
+            unused = next(color for color in ((v, v, 255 - v) for v in range(256)) if color not in opaque)
+            lookup[transparency * 3:transparency * 3 + 3] = unused
+        palette_image = Image.new('P', (1, 1))
+        palette_image.putpalette(lookup)
+        mapped = frame.convert('RGB').quantize(palette=palette_image, dither=Image.Dither.NONE)
+        mapped.putpalette(palette)
+        
+        if has_transparent:
+            mapped.paste(transparency, mask=frame.getchannel('A').point(lambda a: 255 if a < 128 else 0))
+        if transparency is not None:
+            mapped.info['transparency'] = transparency
+        return mapped
+    
+    def map_to_palette(self, frame):
+        """将一帧转换为调色板图片，返回 (图片, 透明色序号)
+
+        P模式的帧已在原调色板内合成水印，直接使用；
+        其他帧（如局部调色板不同的帧）重新量化，不超过255种颜色时颜色完全保留，最后一个序号留给透明像素。
+        """
+        if frame.mode == 'P':
+            transparency = frame.info.get('transparency')
+            return frame, transparency if isinstance(transparency, int) else None
+        
+        mapped = frame.convert('RGB').quantize(255, dither=Image.Dither.NONE)
+        if 'A' not in frame.getbands() or frame.getchannel('A').getextrema()[0] >= 128:
+            return mapped, None
+        
+        palette = mapped.getpalette()
+        transparency = len(palette) // 3
+        mapped.putpalette(palette + [0, 0, 0])
+        transparent = frame.getchannel('A').point(lambda a: 255 if a < 128 else 0)
+        mapped.paste(transparency, mask=transparent)
+        return mapped, transparency
+    
+    def output_variants(self):
+        """不写入文件时的输出列表，返回 [(输出名称, 输出宽度)]
+
+        输出名称由模板名和宽度组成，只有一个输出时为 None。
+        """
+        widths = sorted(set(self.export_settings.get('output_widths') or []), reverse=True)
+        if not widths:
+            return [(self.name, None)]
+        return [('_'.join(str(part) for part in (self.name, width) if part is not None), width)
+                for width in widths]
+    
+    def output_names(self, relative_path, kind=None):
+        """打包输出时各输出在包内的路径，顺序与 render_bytes 的输出一致
+
+        kind 为图片数据的 source_kind，用于确定扩展名。
+        """
+        if self.templates:
+            return [posixpath.join(template.name, name) for template in self.template_processors()
+                    for name in template.output_names(relative_path, kind)]
+        
+        directory, filename = posixpath.split(relative_path)
+        stem = posixpath.splitext(filename)[0]
+        output_format = self.output_format_for(kind)
+        widths = sorted(set(self.export_settings.get('output_widths') or []), reverse=True)
+        return [posixpath.join(directory, self.output_filename(stem, width, output_format))
+                for width in widths or [None]]
+    
+    def output_paths(self, input_path, output_path=None, kind=None):
+        """确定一张图片的所有输出路径，返回 [(路径, 输出宽度)]，未设置多个宽度时宽度为 None
+
+        kind 为 source_kind 的结果，未提供时读取输入文件头确定。
+        """
+        if kind is None:
+            kind = self.source_kind(input_path, input_path)
+        
+        if self.templates:
+            return [item for template in self.template_processors()
+                    for item in template.output_paths(input_path, template.template_output_path(output_path), kind)]
+        
+        output_format = self.output_format_for(kind)
+        widths = sorted(set(self.export_settings.get('output_widths') or []), reverse=True)
+        
+        if output_path:
+            output_path = Path(output_path)
+            if output_format != self.export_settings['output_format']:
+                # 多帧图片和分块TIFF的输出格式与设置不同，扩展名随之改变
+                output_path = output_path.with_suffix(self.output_extensions[output_format])
+            output_path.parent.mkdir(parents=True, exist_ok=True)
+            if not widths:
+                return [(output_path, None)]
+            return [(output_path.with_name(f"{output_path.stem}_{width}{output_path.suffix}"), width)
+                    for width in widths]
+        
+        output_dir = self.export_settings.get('output_dir')
+        if not widths:
+            return [(self.generate_output_path(input_path, output_dir, None, output_format), None)]
+        return [(self.generate_output_path(input_path, output_dir, width, output_format), width) for width in widths]
+    
+    def get_export_size(self, width, height, orientation=1):
+        """根据导出设置计算缩放后的尺寸，不需要缩放时返回 None
+
+        同时指定宽和高时按比例缩放到不超过该尺寸；只指定其一时按比例缩放到该宽或高；
+        都未指定时按百分比缩放。宽高按EXIF方向的显示方向计算，返回存储方向的尺寸。
+        """
+        if not self.export_settings.get('resize_enabled'):
+            return None
+        
+        stored = (width, height)
+        width, height = display_size(stored, orientation)
+        target_width = self.export_settings.get('resize_width') or 0
+        target_height = self.export_settings.get('resize_height') or 0
+        if target_width > 0 and target_height > 0:
+            scale = min(target_width / width, target_height / height)
+        elif target_width > 0:
+            scale = target_width / width
+        elif target_height > 0:
+            scale = target_height / height
+        else:
+            scale = (self.export_settings.get('resize_percent') or 100) / 100
+        
+        size = display_size((max(1, round(width * scale)), max(1, round(height * scale))), orientation)
+        return None if size == stored else size
+    
+    def resize_for_export(self, image, orientation=1):
+        """按导出设置缩放图片，orientation 为EXIF方向
+
+        JPEG 先用 draft 在解码时按 1/2、1/4、1/8 缩小（DCT域缩放），
+        再用 reduce 做整数倍缩小，最后高质量重采样到目标尺寸，避免解码和处理完整大图。
+        """
+        size = self.get_export_size(image.width, image.height, orientation)
+        if size is None:
+            return image
+        
+        if image.format in JPEG_FORMATS:
+            # 必须在解码前调用，解码后的尺寸不小于目标尺寸
+            image.draft(image.mode, size)
+        
+        return self.downscale(image, size)
+    
+    def downscale(self, image, size):
+        """先整数倍缩小，再高质量重采样到目标尺寸"""
+        if image.size == size:
+            return image
+        
+        # 保留至少两倍于目标的尺寸给最后的重采样
+        factor = min(image.width // size[0], image.height // size[1]) // self.reducing_gap
+        if factor > 1:
+            try:
+                image = image.reduce(factor)
+            except ValueError:
+                # 部分模式（如 P）不支持 reduce
+                pass
+        
+        return image.resize(size, Image.Resampling.LANCZOS)
+    
+    def get_source_encoding(self, image):
+        """记录源图片的EXIF方向，以及源JPEG的量化表、色度抽样、EXIF和ICC配置，
+        供添加水印和 jpeg_quality='keep' 时重新编码使用；都没有时返回 None"""
+        source = {}
+        orientation = self.get_orientation(image)
+        if orientation != 1:
+            source['orientation'] = orientation
+        
+        if image.format in JPEG_FORMATS:
+            source.update({
+                'qtables': {index: list(table) for index, table in image.quantization.items()},
+                'subsampling': JpegImagePlugin.get_sampling(image),
+                'exif': image.info.get('exif'),
+                'icc_profile': image.info.get('icc_profile')
+            })
+        return {key: value for key, value in source.items() if value is not None} or None
+    
+    def source_orientation(self, source):
+        """get_source_encoding 记录的EXIF方向"""
+        return source.get('orientation', 1) if source else 1
+    
+    def encode_image(self, image, source=None):
+        """按导出设置将图片编码为字节数据"""
+        return self.encode_output(image, source)[0]
+    
+    def encode_output(self, image, source=None):
+        """按导出设置编码图片，返回 (编码后的数据, 选择的质量)
+
+        jpeg_quality 为 'keep' 时沿用源JPEG的量化表和色度抽样，并保留EXIF和ICC配置，
+        输出大小与原图接近，且不会因重新选择质量而额外损失画质。
+        设置了 max_bytes 时，JPEG/WebP/AVIF 选择不超过该大小的最高质量；未设置时质量为 None。
+        """
+        output_format = self.export_settings['output_format']
+        preset = self.encoder_presets.get(self.export_settings.get('encoder_preset'), self.encoder_presets['balanced'])
+        options = dict(preset.get(output_format, {}))
+        max_bytes = self.export_settings.get('max_bytes') or 0
+        
+        # 像素仍按存储方向保存，输出中保留EXIF方向（沿用源EXIF时由源EXIF提供）
+        orientation = self.source_orientation(source)
+        source = {key: value for key, value in (source or {}).items() if key != 'orientation'}
+        if orientation != 1 and output_format in self.exif_formats:
+            exif = Image.Exif()
+            exif[EXIF_ORIENTATION] = orientation
+            options['exif'] = exif.tobytes()
+        
+        quality = self.export_settings['jpeg_quality']
+        if quality == 'keep' and not (output_format == 'JPEG' and 'qtables' in source):
+            quality = self.keep_fallback_quality
+        
+        if output_format == 'JPEG':
+            if image.mode not in ('1', 'L', 'RGB', 'CMYK'):
+                image = image.convert('RGB')
+            if quality == 'keep':
+                data = self.save_to_bytes(image, 'JPEG', dict(options, **source))
+                if not max_bytes:
+                    return data, None
+                if len(data) <= max_bytes:
+                    return data, 'keep'
+                # 超出大小时改用普通质量查找，仍保留色度抽样和元数据
+                options.update({key: value for key, value in source.items() if key != 'qtables'})
+                quality = self.keep_fallback_quality
+        
+        if output_format in ('JPEG', 'WEBP', 'AVIF'):
+            if max_bytes:
+                return self.encode_within_budget(image, output_format, options, quality, max_bytes)
+            options['quality'] = quality
+        
+        return self.save_to_bytes(image, output_format, options), None
+    
+    def save_to_bytes(self, image, output_format, options):
+        """用指定参数编码图片"""
+        buffer = io.BytesIO()
+        image.save(buffer, output_format, **options)
+        return buffer.getvalue()
+    
+    def encode_within_budget(self, image, output_format, options, max_quality, max_bytes):
+        """查找编码后不超过 max_bytes 的最高质量，返回 (编码后的数据, 质量)
+
+        先用从图片中均匀抽取的小块拼成的样本估算各质量的大小，按估算选择质量做完整编码，
+        再用实际大小校正估算，之后从已知边界附近试探，多数图片只需两到三次完整编码。
+        都超出时返回质量为 1 的结果（仍超出大小上限，见 output_result）。
+        """
+        encoded = {}
+        
+        def encode(quality):
+            if quality not in encoded:
+                encoded[quality] = self.save_to_bytes(image, output_format, dict(options, quality=quality))
+            return encoded[quality]
+        
+        sample = self.size_sample(image)
+        sample_sizes = {}
+        scale = (image.width * image.height) / (sample.width * sample.height) if sample else 1
+        correction = 1.0
+        
+        def sampled_size(quality):
+            """按样本估算的完整编码大小，返回 (文件头等固定开销, 像素数据)，未校正"""
+            if quality not in sample_sizes:
+                sample_options = dict(options, quality=quality)
+                # 用一个编码块大小的图片估算与尺寸无关的固定开销（文件头、量化表、元数据等）
+                overhead = len(self.save_to_bytes(sample.crop((0, 0, 16, 16)), output_format, sample_options))
+                payload = len(self.save_to_bytes(sample, output_format, sample_options)) - overhead
+                sample_sizes[quality] = (overhead, max(payload, 0) * scale)
+            return sample_sizes[quality]
+        
+        def estimate(quality):
+            if sample is None:
+                return len(encode(quality))
+            overhead, payload = sampled_size(quality)
+            return overhead + payload * correction
+        
+        low, high = 1, max_quality
+        best = None
+        attempts = 0
+        step = 1
+        while low <= high:
+            if attempts >= self.size_guided_attempts:
+                # 估算已校正过，结果通常就在边界附近：从已知边界逐步加倍步长试探，而不是重新二分
+                if best is not None:
+                    quality = min(low + step - 1, high)
                 else:
-                    watermarked_img.save(output_path, 'PNG')
-                
-                return str(output_path)
+                    quality = max(high - step + 1, low)
+            else:
+                # 估算范围内不超出大小的最高质量
+                quality = low
+                search_low, search_high = low, high
+                while search_low <= search_high:
+                    middle = (search_low + search_high) // 2
+                    if estimate(middle) <= max_bytes:
+                        quality = middle
+                        search_low = middle + 1
+                    else:
+                        search_high = middle - 1
+            
+            data = encode(quality)
+            attempts += 1
+            if sample is not None:
+                overhead, payload = sampled_size(quality)
+                if payload:
+                    correction = max(len(data) - overhead, 1) / payload
+            
+            fits = len(data) <= max_bytes
+            # 连续朝同一方向移动时加倍步长，方向改变时回到相邻质量
+            if attempts > self.size_guided_attempts:
+                step = step * 2 if fits == (best is not None) else 1
+            if fits:
+                best = (data, quality)
+                low = quality + 1
+            else:
+                high = quality - 1
         
+        return best or (encode(1), 1)
+    
+    def size_sample(self, image):
+        """从图片中均匀抽取小块拼成样本，图片太小时返回 None（直接完整编码）"""
+        grid = self.size_sample_grid
+        tile = self.size_sample_tile
+        if image.width < tile * grid * 2 or image.height < tile * grid * 2:
+            return None
+        
+        sample = Image.new(image.mode, (tile * grid, tile * grid))
+        if image.mode == 'P':
+            sample.putpalette(image.getpalette())
+        for row in range(grid):
+            for column in range(grid):
+                # 对齐到16像素，与JPEG的编码块一致
+                x = (image.width - tile) * column // (grid - 1) // 16 * 16
+                y = (image.height - tile) * row // (grid - 1) // 16 * 16
+                sample.paste(image.crop((x, y, x + tile, y + tile)), (column * tile, row * tile))
+        return sample
+    
+    def write_output(self, data, output_path):
+        """写入输出文件：先写入同目录下的临时文件，完成后原子地重命名为目标文件
+
+        重命名前后都刷到磁盘，返回后（检查点日志记录完成之前）即使断电，输出也是完整的。
+        """
+        output_path = Path(output_path)
+        tmp_path = output_path.with_name(f".{output_path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, output_path)
+            sync_directory(output_path.parent)
+        except BaseException:
+            # 中断或失败时不留下不完整的文件
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+    
+    def save_image(self, image, output_path):
+        """编码并保存图片"""
+        self.write_output(self.encode_image(image), output_path)
+    
+    def decode_to_shared(self, input_path, auto_date=False):
+        """解码图片并将像素放入共享内存，返回供其他进程使用的描述信息"""
+        try:
+            data = self.read_file(input_path)
+            with Image.open(io.BytesIO(data)) as img:
+                if is_multiframe(img):
+                    # 多帧图片由各模板的工作进程分别逐帧处理
+                    return {'frames': True, 'auto_date': auto_date}
+                date = self.get_image_date(img, data, input_path) if auto_date and self.needs_date() else None
+                raw = img.tobytes()
+                descriptor = {
+                    'mode': img.mode,
+                    'size': img.size,
+                    'palette': img.getpalette() if img.mode == 'P' else None,
+                    # 透明色等信息随描述传递，调色板图片合成水印时需要
+                    'info': {key: value for key, value in img.info.items()
+                             if isinstance(value, (int, float, str, bytes, tuple))},
+                    'date': date,
+                    'source': self.get_source_encoding(img)
+                }
+            
+            shm = shared_memory.SharedMemory(create=True, size=max(len(raw), 1))
+            shm.buf[:len(raw)] = raw
+            descriptor['shm'] = shm.name
+            shm.close()
+            return descriptor
         except Exception as e:
-            raise Exception(f"处理图片 {input_path} 失败: {e}")
+            return {'error': f"处理图片 {input_path} 失败: {e}"}
+    
+    def render_from_shared(self, input_path, descriptor, template_index):
+        """从共享内存中的解码图片按指定模板渲染并写出，返回结果记录"""
+        try:
+            if descriptor.get('frames'):
+                template = self.template_processors()[template_index]
+                outputs = template.render_outputs(input_path, self.read_file(input_path),
+                                                  auto_date=descriptor['auto_date'])
+                for output_path, encoded, quality in outputs:
+                    self.write_output(encoded, output_path)
+                return self.output_result(input_path, outputs)
+            
+            shm = shared_memory.SharedMemory(name=descriptor['shm'])
+            try:
+                mode = descriptor['mode']
+                img = Image.frombuffer(mode, tuple(descriptor['size']), shm.buf, 'raw', mode, 0, 1)
+                if descriptor['palette']:
+                    img.putpalette(descriptor['palette'])
+                img.info.update(descriptor['info'])
+                template = self.template_processors()[template_index]
+                outputs = template.render_decoded(input_path, img, template.date_text(descriptor['date']),
+                                                  source=descriptor['source'])
+                img.close()
+                img = None
+            finally:
+                try:
+                    shm.close()
+                except BufferError:
+                    pass
+            
+            for output_path, encoded, quality in outputs:
+                self.write_output(encoded, output_path)
+            return self.output_result(input_path, outputs)
+        except Exception as e:
+            return {'input': input_path, 'error': f"处理图片 {input_path} 失败: {e}", 'success': False}
     
-    def process_batch(self, input_paths, output_dir=None, auto_date=False, progress_callback=None):
-        """批量处理图片"""
+    def release_shared(self, descriptor):
+        """释放解码图片占用的共享内存"""
+        try:
+            shm = shared_memory.SharedMemory(name=descriptor['shm'])
+            shm.close()
+            shm.unlink()
+        except (OSError, KeyError):
+            pass
+    
+    def process_batch(self, input_paths, output_dir=None, auto_date=False, progress_callback=None, jobs=None,
+                      incremental=False, content_hash=False, journal=None, resume=False,
+                      pipeline=False, queue_depth=None):
+        """批量处理图片
+
+        jobs 为并行进程数，默认使用CPU核心数；jobs=1 时在当前进程中顺序处理。
+        pipeline=True 时改用单进程的线程流水线，jobs 为处理线程数，queue_depth 为各段队列长度。
+        结果始终按输入顺序返回，进度回调在主进程中调用。
+        incremental=True 时跳过输入文件和设置都未变化的图片，content_hash 额外比较文件内容。
+        journal 为检查点日志路径，resume=True 时跳过日志中已完成的图片，不再检查其输出。
+        """
         results = []
-        total = len(input_paths)
+        # input_paths 可以是生成器（如 iter_images），此时总数未知
+        total = len(input_paths) if hasattr(input_paths, '__len__') else None
+        jobs = self.resolve_jobs(jobs)
+        if total is not None:
+            jobs = min(jobs, total)
         
-        for i, input_path in enumerate(input_paths):
-            try:
-                output_path = self.process_image(input_path, None, auto_date)
-                results.append({'input': input_path, 'output': output_path, 'success': True})
+        manifest = BatchManifest(self.settings_hash(auto_date), content_hash) if incremental else None
+        if journal:
+            journal = BatchJournal(journal)
+            journal.open(resume)
+        tasks = self._plan_batch(input_paths, manifest, journal)
+        
+        if pipeline and not self.export_settings.get('tiled_tiff'):
+            # 分块TIFF不能整体读入内存，不使用流水线
+            result_iter = self._iter_pipeline(tasks, auto_date, jobs, queue_depth)
+        elif jobs > 1:
+            result_iter = self._iter_parallel(tasks, auto_date, jobs)
+        else:
+            result_iter = (ready or self._process_one(input_path, auto_date) for input_path, ready in tasks)
+        
+        finished = False
+        try:
+            for i, result in enumerate(result_iter):
+                results.append(result)
+                
+                if result['success']:
+                    if not result.get('skipped'):
+                        if journal:
+                            journal.record(result['input'], result['output'])
+                        if manifest:
+                            manifest.record(result['input'], result['output'])
+                    if progress_callback:
+                        progress_callback(i + 1, total, result['input'])
+                else:
+                    print(f"错误: {result['error']}")
+            finished = True
+        finally:
+            if manifest:
+                manifest.save()
+            if journal:
+                journal.close(finished)
+        
+        return results
+    
+    def process_tar_stream(self, input_stream, output_stream, auto_date=False, progress_callback=None):
+        """处理tar流中的所有图片，结果按原目录结构写入输出tar流
+
+        输入和输出都按流顺序读写，不需要可定位的文件，适合在管道中由一个进程处理大量图片。
+        """
+        results = []
+        with tarfile.open(fileobj=input_stream, mode='r|*') as source, \
+                tarfile.open(fileobj=output_stream, mode='w|') as target:
+            for member in source:
+                if not member.isfile() or Path(member.name).suffix.lower() not in self.supported_formats:
+                    continue
                 
                 if progress_callback:
-                    progress_callback(i + 1, total, input_path)
-                    
-            except Exception as e:
-                results.append({'input': input_path, 'error': str(e), 'success': False})
-                print(f"错误: {e}")
+                    progress_callback(len(results) + 1, None, member.name)
+                
+                try:
+                    data = source.extractfile(member).read()
+                    outputs = self.render_bytes(data, auto_date=auto_date)
+                    names = self.output_names(member.name, self.source_kind(io.BytesIO(data)))
+                    for name, (label, encoded, quality) in zip(names, outputs):
+                        info = tarfile.TarInfo(name)
+                        info.size = len(encoded)
+                        info.mtime = member.mtime
+                        info.mode = 0o644
+                        target.addfile(info, io.BytesIO(encoded))
+                    output_stream.flush()
+                    results.append(self.output_result(member.name, [(name,) + output[1:] for name, output in zip(names, outputs)]))
+                except Exception as e:
+                    results.append({'input': member.name, 'error': f"处理图片 {member.name} 失败: {e}", 'success': False})
+                    print(f"错误: {results[-1]['error']}", file=sys.stderr)
         
         return results
     
+    def process_archive(self, input_path, output_path=None, auto_date=False, progress_callback=None,
+                        workers=None, queue_depth=None):
+        """处理zip/tar包中的图片，不解压到磁盘
+
+        图片按需从包中读取，编码后的输出依次写入输出包（output_path 以 .zip/.tar 结尾）或输出目录；
+        使用线程流水线处理，内存占用只与在途的图片数量有关。
+        输入也可以是目录，此时输出到包中。
+        """
+        if Path(input_path).is_dir():
+            reader = None
+            names = [Path(path).relative_to(input_path).as_posix() for path in self.iter_images(input_path, sort=True)]
+            read = lambda name: self.read_file(Path(input_path) / name)
+        else:
+            reader = ArchiveReader(input_path, self.supported_formats)
+            names = reader.names()
+            read = reader.read
+        
+        writer = None
+        if output_path and is_archive(output_path):
+            writer = ArchiveWriter(output_path)
+        else:
+            output_dir = Path(output_path) if output_path else Path(input_path).parent / self.default_output_dirname
+        
+        def render(name, data):
+            # 包内名称的扩展名随图片数据确定（如多帧图片）
+            return self.output_names(name, self.source_kind(open_buffer(data))), self.render_bytes(data, auto_date=auto_date)
+        
+        def write(name, rendered):
+            output_names, outputs = rendered
+            named_outputs = []
+            for output_name, (label, encoded, quality) in zip(output_names, outputs):
+                if writer:
+                    writer.write(output_name, encoded)
+                else:
+                    target = output_dir / output_name
+                    target.parent.mkdir(parents=True, exist_ok=True)
+                    self.write_output(encoded, target)
+                    output_name = str(target)
+                named_outputs.append((output_name, encoded, quality))
+            return self.output_result(name, named_outputs)
+        
+        workers = min(self.resolve_jobs(workers), max(len(names), 1))
+        tasks = ((name, None) for name in names)
+        
+        results = []
+        finished = False
+        try:
+            for i, result in enumerate(self._iter_pipeline(tasks, auto_date, workers, queue_depth,
+                                                           read, render, write)):
+                results.append(result)
+                if result['success']:
+                    if progress_callback:
+                        progress_callback(i + 1, len(names), result['input'])
+                else:
+                    print(f"错误: {result['error']}")
+            finished = True
+        finally:
+            if reader:
+                reader.close()
+            if writer:
+                writer.close(finished)
+        
+        return results
+    
+    def journal_path(self, input_path, auto_date=False):
+        """根据输入路径和设置确定检查点日志路径，相同的批处理任务使用同一个日志"""
+        key = f"{os.path.abspath(input_path)}|{self.settings_hash(auto_date)}"
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+        return Path.home() / ".watermark_journals" / f"{name}.jsonl"
+    
+    def settings_hash(self, auto_date=False):
+        """计算影响输出结果的设置的哈希"""
+        settings = {
+            'watermark': self.watermark_settings,
+            'export': self.export_settings,
+            'templates': self.templates,
+            'auto_date': auto_date
+        }
+        data = json.dumps(settings, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+    
+    def _plan_batch(self, input_paths, manifest=None, journal=None):
+        """为每个输入产出 (路径, 已有结果)，无需处理的图片直接给出跳过结果"""
+        for input_path in input_paths:
+            ready = None
+            if journal and input_path in journal.completed:
+                ready = {'input': input_path, 'output': journal.completed[input_path],
+                         'success': True, 'skipped': 'resumed'}
+            elif manifest:
+                try:
+                    output_path = self.output_paths(input_path)[0][0]
+                    if manifest.is_up_to_date(input_path, output_path):
+                        ready = {'input': input_path, 'output': str(output_path),
+                                 'success': True, 'skipped': 'unchanged'}
+                except OSError:
+                    pass
+            yield input_path, ready
+    
+    def resolve_jobs(self, jobs=None):
+        """确定并行进程数"""
+        if not jobs or jobs < 1:
+            return os.cpu_count() or 1
+        return jobs
+    
+    def _process_one(self, input_path, auto_date=False):
+        """处理单张图片并返回结果记录"""
+        try:
+            return self.process_image_result(input_path, None, auto_date)
+        except Exception as e:
+            return {'input': input_path, 'error': str(e), 'success': False}
+    
+    def _iter_parallel(self, tasks, auto_date, jobs):
+        """使用进程池处理图片，按输入顺序产出结果"""
+        # 先在主进程中生成字体索引，避免每个工作进程重复扫描
+        watermark_fonts.load_font_index()
+        
+        if self.templates:
+            yield from self._iter_parallel_templates(tasks, auto_date, jobs)
+            return
+        
+        # 设置只在工作进程初始化时发送一次，每个任务只传递文件路径
+        initargs = (dict(self.watermark_settings), dict(self.export_settings))
+        max_pending = jobs * 4
+        
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=initargs) as executor:
+            pending = deque()
+            try:
+                for input_path, ready in tasks:
+                    if ready is not None:
+                        pending.append(ready)
+                    else:
+                        pending.append(executor.submit(_process_in_worker, input_path, auto_date))
+                    # 限制在途任务数量，避免一次性提交全部任务
+                    if len(pending) >= max_pending:
+                        yield self._pending_result(pending.popleft())
+                
+                while pending:
+                    yield self._pending_result(pending.popleft())
+            finally:
+                # 提前结束（如被中断）时取消尚未开始的任务
+                for item in pending:
+                    if isinstance(item, Future):
+                        item.cancel()
+    
+    def _iter_parallel_templates(self, tasks, auto_date, jobs):
+        """多模板并行处理，按输入顺序产出结果
+
+        每张图片只由一个工作进程解码，像素放入共享内存，
+        再由多个工作进程分别按各模板渲染，全部完成后释放共享内存。
+        """
+        if os.name == 'posix':
+            # 在主进程中启动资源跟踪进程，使工作进程创建的共享内存由同一个进程跟踪
+            resource_tracker.ensure_running()
+        
+        initargs = (dict(self.watermark_settings), dict(self.export_settings), list(self.templates))
+        template_count = len(self.templates)
+        # 同时保留在共享内存中的解码图片数量
+        max_pending = jobs + 2
+        
+        tasks = iter(tasks)
+        exhausted = False
+        pending = deque()  # 每项: {'input', 'ready', 'decode', 'descriptor', 'renders'}
+        try:
+            with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=initargs) as executor:
+                try:
+                    while True:
+                        # 补充解码任务
+                        while not exhausted and len(pending) < max_pending:
+                            try:
+                                input_path, ready = next(tasks)
+                            except StopIteration:
+                                exhausted = True
+                                break
+                            item = {'input': input_path, 'ready': ready, 'decode': None,
+                                    'descriptor': None, 'renders': None}
+                            if ready is None:
+                                item['decode'] = executor.submit(_decode_in_worker, input_path, auto_date)
+                            pending.append(item)
+                        
+                        if not pending:
+                            break
+                        
+                        # 解码完成的图片提交各模板的渲染任务
+                        for item in pending:
+                            if item['decode'] is None or item['renders'] is not None or not item['decode'].done():
+                                continue
+                            descriptor = item['decode'].result()
+                            if 'error' in descriptor:
+                                item['ready'] = {'input': item['input'], 'error': descriptor['error'], 'success': False}
+                                item['renders'] = []
+                            else:
+                                item['descriptor'] = descriptor
+                                item['renders'] = [executor.submit(_render_shared_in_worker, item['input'], descriptor, i)
+                                                   for i in range(template_count)]
+                        
+                        head = pending[0]
+                        if head['ready'] is not None or (head['renders'] and all(f.done() for f in head['renders'])):
+                            pending.popleft()
+                            yield self._template_result(head)
+                            continue
+                        
+                        # 等待任意任务完成
+                        running = [f for item in pending for f in ([item['decode']] if item['decode'] else []) +
+                                   (item['renders'] or []) if not f.done()]
+                        wait(running, return_when=FIRST_COMPLETED)
+                finally:
+                    # 提前结束（如被中断）时取消尚未开始的任务
+                    for item in pending:
+                        for future in [item['decode']] + (item['renders'] or []):
+                            if future is not None:
+                                future.cancel()
+        finally:
+            # 工作进程全部结束后释放剩余的共享内存
+            for item in pending:
+                decode = item['decode']
+                if decode is not None and decode.done() and not decode.cancelled():
+                    descriptor = decode.result()
+                    if 'shm' in descriptor:
+                        self.release_shared(descriptor)
+    
+    def _template_result(self, item):
+        """汇总一张图片各模板的渲染结果，并释放其共享内存"""
+        if item['descriptor']:
+            self.release_shared(item['descriptor'])
+            item['descriptor'] = None
+            item['decode'] = None
+        
+        if item['ready'] is not None:
+            return item['ready']
+        
+        results = [future.result() for future in item['renders']]
+        for result in results:
+            if not result['success']:
+                return result
+        
+        result = dict(results[0])
+        qualities = [quality for r in results for quality in r.get('qualities', [None])]
+        if any(quality is not None for quality in qualities):
+            result['quality'] = qualities[0]
+            result['qualities'] = qualities
+        if any(r.get('over_budget') for r in results):
+            result['over_budget'] = True
+        return result
+    
+    def _iter_pipeline(self, tasks, auto_date, workers, queue_depth=None, read=None, render=None, write=None):
+        """使用 读取 → 解码/水印/编码 → 写入 三段线程流水线处理图片，按输入顺序产出结果
+
+        各段之间用有界队列连接；Pillow 解码和编码时会释放GIL，
+        因此磁盘读写可以与计算重叠，内存占用由队列长度限制。
+        read(输入)、render(输入, 数据)、write(输入, 输出列表) 可替换各段的默认处理（如读写压缩包），
+        读取和写入各只在一个线程中进行，写入也按输入顺序进行（压缩包中的条目顺序与输入一致）。
+        """
+        read = read or self.read_file
+        render = render or (lambda input_path, data: self.render_outputs(input_path, data, None, auto_date))
+        
+        def write_files(input_path, outputs):
+            for output_path, encoded, quality in outputs:
+                self.write_output(encoded, output_path)
+            return self.output_result(input_path, outputs)
+        
+        write = write or write_files
+        queue_depth = queue_depth or workers * 2
+        read_queue = queue.Queue(queue_depth)
+        render_queue = queue.Queue(queue_depth)
+        write_queue = queue.Queue(queue_depth)
+        stop = threading.Event()
+        
+        def failure(input_path, e):
+            return {'input': input_path, 'error': f"处理图片 {input_path} 失败: {e}", 'success': False}
+        
+        def fail(index, input_path, future, e):
+            future.set_result(failure(input_path, e))
+            # 通知写入线程该序号没有需要写入的内容
+            write_queue.put((index, None))
+        
+        def reader():
+            while True:
+                item = read_queue.get()
+                if item is None:
+                    break
+                index, input_path, future = item
+                if stop.is_set():
+                    future.cancel()
+                    continue
+                try:
+                    data = read(input_path)
+                except Exception as e:
+                    fail(index, input_path, future, e)
+                    continue
+                render_queue.put((index, input_path, future, data))
+            
+            for _ in range(workers):
+                render_queue.put(None)
+        
+        def renderer():
+            while True:
+                item = render_queue.get()
+                if item is None:
+                    break
+                index, input_path, future, data = item
+                if stop.is_set():
+                    future.cancel()
+                    continue
+                try:
+                    outputs = render(input_path, data)
+                except Exception as e:
+                    fail(index, input_path, future, e)
+                    continue
+                write_queue.put((index, (input_path, future, outputs)))
+            
+            write_queue.put(None)
+        
+        def writer():
+            # 先完成的条目暂存，等前面的条目写出后再按顺序写出；在途任务数有上限，暂存的数量也有上限
+            waiting = {}
+            next_index = 0
+            running = workers
+            while running:
+                item = write_queue.get()
+                if item is None:
+                    running -= 1
+                    continue
+                index, job = item
+                waiting[index] = job
+                while next_index in waiting:
+                    job = waiting.pop(next_index)
+                    next_index += 1
+                    if job is None:
+                        continue
+                    input_path, future, outputs = job
+                    if stop.is_set():
+                        future.cancel()
+                        continue
+                    try:
+                        result = write(input_path, outputs)
+                    except Exception as e:
+                        future.set_result(failure(input_path, e))
+                        continue
+                    future.set_result(result)
+            
+            for job in waiting.values():
+                if job is not None:
+                    job[1].cancel()
+        
+        threads = [threading.Thread(target=reader, daemon=True)]
+        threads += [threading.Thread(target=renderer, daemon=True) for _ in range(workers)]
+        threads.append(threading.Thread(target=writer, daemon=True))
+        for thread in threads:
+            thread.start()
+        
+        # 在途任务数不超过流水线各段的总容量
+        max_pending = queue_depth * 3 + workers + 2
+        pending = deque()
+        submitted = 0
+        try:
+            for input_path, ready in tasks:
+                if ready is not None:
+                    pending.append(ready)
+                else:
+                    future = Future()
+                    read_queue.put((submitted, input_path, future))
+                    submitted += 1
+                    pending.append(future)
+                if len(pending) >= max_pending:
+                    yield self._pending_result(pending.popleft())
+            
+            while pending:
+                yield self._pending_result(pending.popleft())
+        finally:
+            # 提前结束（如被中断）时丢弃尚未完成的任务
+            if pending:
+                stop.set()
+            read_queue.put(None)
+            for thread in threads:
+                thread.join()
+    
+    def _pending_result(self, item):
+        """取出在途任务的结果"""
+        return item.result() if isinstance(item, Future) else item
+    
     def save_template(self, template_name, template_dir=None):
         """保存水印模板"""
         if not template_dir:
@@ -291,6 +2343,51 @@ class WatermarkProcessor:
         
         return str(template_file)
     
+    def add_template(self, template_file):
+        """添加一个输出模板，每张图片会按所有已添加的模板分别输出"""
+        with open(template_file, 'r', encoding='utf-8') as f:
+            template_data = json.load(f)
+        
+        self.templates.append({
+            'name': Path(template_file).stem,
+            'watermark': template_data.get('watermark', {}),
+            'export': template_data.get('export', {})
+        })
+        self._template_processors = None
+    
+    def template_processors(self):
+        """为每个模板创建处理器，模板设置覆盖当前设置，输出到以模板名命名的子目录"""
+        if self._template_processors is None:
+            processors = []
+            for template in self.templates:
+                processor = WatermarkProcessor()
+                processor.name = template['name']
+                processor.watermark_settings.update(self.watermark_settings)
+                processor.watermark_settings.update(template['watermark'])
+                processor.export_settings.update(self.export_settings)
+                processor.export_settings.update(template['export'])
+                
+                output_dir = self.export_settings.get('output_dir')
+                if output_dir:
+                    processor.export_settings['output_dir'] = os.path.join(output_dir, template['name'])
+                else:
+                    processor.export_settings['output_dir'] = ''
+                    processor.default_output_dirname = os.path.join(self.default_output_dirname, template['name'])
+                
+                # 图章缓存的键包含全部样式设置，可以共用
+                processor.stamp_cache = self.stamp_cache
+                processor.pattern_cache = self.pattern_cache
+                processors.append(processor)
+            self._template_processors = processors
+        return self._template_processors
+    
+    def template_output_path(self, output_path):
+        """将指定的输出路径映射到模板的子目录"""
+        if not output_path:
+            return None
+        output_path = Path(output_path)
+        return output_path.parent / self.name / output_path.name
+    
     def load_template(self, template_file):
         """加载水印模板"""
         with open(template_file, 'r', encoding='utf-8') as f:
@@ -327,33 +2424,98 @@ class WatermarkProcessor:
         
         return templates
 
+# 进程池工作进程中的处理器实例
+_worker_processor = None
+
+def _init_worker(watermark_settings, export_settings, templates=()):
+    """初始化工作进程的处理器"""
+    global _worker_processor
+    _worker_processor = WatermarkProcessor()
+    _worker_processor.watermark_settings.update(watermark_settings)
+    _worker_processor.export_settings.update(export_settings)
+    _worker_processor.templates = list(templates)
+
+def _process_in_worker(input_path, auto_date):
+    """在工作进程中处理单张图片"""
+    return _worker_processor._process_one(input_path, auto_date)
+
+def _decode_in_worker(input_path, auto_date):
+    """在工作进程中解码图片到共享内存"""
+    return _worker_processor.decode_to_shared(input_path, auto_date)
+
+def _render_shared_in_worker(input_path, descriptor, template_index):
+    """在工作进程中从共享内存按模板渲染图片"""
+    return _worker_processor.render_from_shared(input_path, descriptor, template_index)
+
+def parse_widths(value):
+    """解析逗号分隔的宽度列表"""
+    try:
+        widths = [int(w) for w in value.split(',') if w.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"无效的宽度列表: {value}")
+    if not widths or min(widths) <= 0:
+        raise argparse.ArgumentTypeError(f"无效的宽度列表: {value}")
+    return widths
+
+def parse_quality(value):
+    """解析JPEG质量参数：1-100 或 keep"""
+    if value.lower() == 'keep':
+        return 'keep'
+    try:
+        quality = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"无效的质量: {value}")
+    if not 1 <= quality <= 100:
+        raise argparse.ArgumentTypeError(f"质量必须在 1-100 之间: {value}")
+    return quality
+
 def create_parser():
     """创建命令行参数解析器"""
     parser = argparse.ArgumentParser(description='Image Watermarker v2.0 - 高级图片水印工具')
     
     # 基本参数
-    parser.add_argument('input', help='输入图片文件或目录')
-    parser.add_argument('-o', '--output', help='输出目录')
+    parser.add_argument('input', help='输入图片文件、目录或 .zip/.tar 包，- 表示从标准输入读取')
+    parser.add_argument('-o', '--output', help='输出目录，或以 .zip/.tar 结尾的输出包')
+    parser.add_argument('--stdout', action='store_true', help='将输出图片写到标准输出（只用于单张图片）')
+    parser.add_argument('--tar-stream', action='store_true',
+                       help='从标准输入读取tar流，处理其中的所有图片，结果以tar流写到标准输出')
     parser.add_argument('-t', '--text', default='', help='水印文本')
     parser.add_argument('--auto-date', action='store_true', help='自动使用EXIF日期作为水印')
     
     # 水印样式参数
     parser.add_argument('--font-size', type=int, default=36, help='字体大小 (默认: 36)')
+    parser.add_argument('--font-family', default='Arial', help='字体 (默认: Arial)')
+    parser.add_argument('--bold', action='store_true', help='粗体')
+    parser.add_argument('--italic', action='store_true', help='斜体')
     parser.add_argument('--color', default='#FFFFFF', help='文字颜色 (默认: #FFFFFF)')
     parser.add_argument('--opacity', type=int, default=100, help='透明度 0-100 (默认: 100)')
     parser.add_argument('--position', default='bottom_right', 
                        choices=['top_left', 'top_center', 'top_right', 
                                'middle_left', 'center', 'middle_right',
-                               'bottom_left', 'bottom_center', 'bottom_right'],
-                       help='水印位置 (默认: bottom_right)')
+                               'bottom_left', 'bottom_center', 'bottom_right', 'tiled'],
+                       help='水印位置，tiled 为平铺整张图片 (默认: bottom_right)')
+    parser.add_argument('--rotation', type=float, default=0, help='水印逆时针旋转角度 (默认: 0)')
+    parser.add_argument('--tile-spacing', type=int, default=100, help='平铺水印的图章间距 (默认: 100)')
     parser.add_argument('--x-offset', type=int, default=10, help='水平偏移 (默认: 10)')
     parser.add_argument('--y-offset', type=int, default=10, help='垂直偏移 (默认: 10)')
     parser.add_argument('--shadow', action='store_true', help='添加阴影效果')
     parser.add_argument('--outline', action='store_true', help='添加描边效果')
     
     # 输出参数
-    parser.add_argument('--format', choices=['JPEG', 'PNG'], default='JPEG', help='输出格式 (默认: JPEG)')
-    parser.add_argument('--quality', type=int, default=95, help='JPEG质量 1-100 (默认: 95)')
+    parser.add_argument('--format', choices=['JPEG', 'PNG', 'WEBP', 'AVIF'], default='JPEG', help='输出格式 (默认: JPEG)')
+    parser.add_argument('--quality', type=parse_quality, default=95,
+                       help='JPEG/WebP/AVIF质量 1-100，或 keep 沿用原图的量化表并保留EXIF/ICC (默认: 95)')
+    parser.add_argument('--tiled', action='store_true',
+                       help='分块TIFF只重写与水印重叠的图块，内存占用与图片大小无关（输出为TIFF，不缩放）')
+    parser.add_argument('--max-bytes', type=int, default=0,
+                       help='输出文件大小上限（字节），JPEG/WebP/AVIF 自动选择不超过该大小的最高质量')
+    parser.add_argument('--encoder-preset', choices=['fast', 'balanced', 'small'], default='balanced',
+                       help='编码预设：fast 编码最快，small 文件最小 (默认: balanced)')
+    parser.add_argument('--resize-width', type=int, help='缩放到指定宽度（保持比例）')
+    parser.add_argument('--resize-height', type=int, help='缩放到指定高度（保持比例）')
+    parser.add_argument('--resize-percent', type=int, help='按百分比缩放')
+    parser.add_argument('--widths', type=parse_widths,
+                       help='同时输出多个宽度（逗号分隔，如 2560,1280,640,320），每张图片只解码一次')
     parser.add_argument('--naming', choices=['original', 'prefix', 'suffix'], default='suffix',
                        help='文件命名方式 (默认: suffix)')
     parser.add_argument('--prefix', default='wm_', help='文件名前缀 (默认: wm_)')
@@ -361,9 +2523,20 @@ def create_parser():
     
     # 模板参数
     parser.add_argument('--save-template', help='保存当前设置为模板')
-    parser.add_argument('--load-template', help='加载模板文件')
+    parser.add_argument('--load-template', nargs='+',
+                       help='加载模板文件；指定多个模板时每个模板分别输出到以模板名命名的子目录')
     parser.add_argument('--list-templates', action='store_true', help='列出可用模板')
     
+    # 性能参数
+    parser.add_argument('--incremental', action='store_true', help='增量处理，跳过输入和设置都未变化的图片')
+    parser.add_argument('--content-hash', action='store_true', help='增量处理时比较文件内容哈希')
+    parser.add_argument('--resume', action='store_true', help='从检查点日志继续上次中断的批处理')
+    parser.add_argument('--sort', action='store_true', help='按文件名顺序处理目录中的图片')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='并行处理进程数 (默认: CPU核心数)')
+    parser.add_argument('--pipeline', action='store_true',
+                       help='使用单进程线程流水线（读取/处理/写入分段并行），--jobs 为处理线程数')
+    parser.add_argument('--queue-depth', type=int, default=None, help='流水线各段队列长度 (默认: 处理线程数x2)')
+    
     # 其他参数
     parser.add_argument('--preview', action='store_true', help='仅预览设置，不处理图片')
     parser.add_argument('-v', '--verbose', action='store_true', help='详细输出')
@@ -372,6 +2545,9 @@ def create_parser():
 
 def progress_callback(current, total, filename):
     """进度回调函数"""
+    if not total:
+        print(f"进度: {current} - {Path(filename).name}")
+        return
     percentage = (current / total) * 100
     print(f"进度: {current}/{total} ({percentage:.1f}%) - {Path(filename).name}")
 
@@ -379,6 +2555,15 @@ def main():
     parser = create_parser()
     args = parser.parse_args()
     
+    if args.tar_stream and args.input != '-':
+        parser.error('--tar-stream 需要使用 - 作为输入')
+    
+    # 标准输出用于输出图片数据时，提示信息改为输出到标准错误
+    data_output = None
+    if args.input == '-' or args.stdout or args.tar_stream:
+        data_output = sys.stdout.buffer
+        sys.stdout = sys.stderr
+    
     # 创建处理器
     processor = WatermarkProcessor()
     
@@ -396,8 +2581,12 @@ def main():
     # 加载模板
     if args.load_template:
         try:
-            processor.load_template(args.load_template)
-            print(f"已加载模板: {args.load_template}")
+            if len(args.load_template) == 1:
+                processor.load_template(args.load_template[0])
+            else:
+                for template_file in args.load_template:
+                    processor.add_template(template_file)
+            print(f"已加载模板: {', '.join(args.load_template)}")
         except Exception as e:
             print(f"加载模板失败: {e}")
             return
@@ -406,9 +2595,14 @@ def main():
     processor.watermark_settings.update({
         'text': args.text,
         'font_size': args.font_size,
+        'font_family': args.font_family,
+        'bold': args.bold,
+        'italic': args.italic,
         'color': args.color,
         'opacity': args.opacity,
         'position': args.position,
+        'rotation': args.rotation,
+        'tile_spacing': args.tile_spacing,
         'x_offset': args.x_offset,
         'y_offset': args.y_offset,
         'shadow': args.shadow,
@@ -421,13 +2615,28 @@ def main():
         'custom_prefix': args.prefix,
         'custom_suffix': args.suffix,
         'output_format': args.format,
-        'jpeg_quality': args.quality
+        'encoder_preset': args.encoder_preset,
+        'jpeg_quality': args.quality,
+        'max_bytes': args.max_bytes,
+        'tiled_tiff': args.tiled
     })
     
+    if args.widths:
+        processor.export_settings['output_widths'] = args.widths
+    
+    if args.resize_width or args.resize_height or args.resize_percent:
+        processor.export_settings.update({
+            'resize_enabled': True,
+            'resize_width': args.resize_width or 0,
+            'resize_height': args.resize_height or 0,
+            'resize_percent': args.resize_percent or 100
+        })
+    
     # 预览设置
     if args.preview:
         print("当前水印设置:")
         print(f"  文本: {processor.watermark_settings['text']}")
+        print(f"  字体: {processor.watermark_settings['font_family']}")
         print(f"  字体大小: {processor.watermark_settings['font_size']}")
         print(f"  颜色: {processor.watermark_settings['color']}")
         print(f"  透明度: {processor.watermark_settings['opacity']}%")
@@ -438,6 +2647,7 @@ def main():
         print("\n输出设置:")
         print(f"  格式: {processor.export_settings['output_format']}")
         print(f"  质量: {processor.export_settings['jpeg_quality']}")
+        print(f"  编码预设: {processor.export_settings['encoder_preset']}")
         print(f"  命名: {processor.export_settings['naming_option']}")
         return
     
@@ -450,39 +2660,109 @@ def main():
             print(f"保存模板失败: {e}")
     
     # 查找图片文件
-    if not os.path.exists(args.input):
+    if args.input != '-' and not os.path.exists(args.input):
         print(f"错误: 输入路径不存在: {args.input}")
         return
     
-    images = processor.find_images(args.input)
-    if not images:
-        print("没有找到支持的图片文件")
-        return
-    
-    print(f"找到 {len(images)} 张图片")
-    
     # 处理图片
-    if not args.text and not args.auto_date:
-        print("警告: 没有指定水印文本，将使用自动日期")
+    # 有输出没有水印文本时改用自动日期；自带文本的模板仍使用模板文本，见 date_text
+    if not args.text and not args.auto_date and processor.needs_date():
+        if processor.templates:
+            names = ', '.join(template.name for template in processor.template_processors() if template.needs_date())
+            print(f"警告: 模板 {names} 没有水印文本，将使用自动日期")
+        else:
+            print("警告: 没有指定水印文本，将使用自动日期")
         args.auto_date = True
     
     try:
-        if len(images) == 1:
+        if args.tar_stream:
+            results = processor.process_tar_stream(sys.stdin.buffer, data_output, args.auto_date,
+                                                   progress_callback if args.verbose else None)
+            success_count = sum(1 for r in results if r['success'])
+            print(f"处理完成: {success_count}/{len(results)} 张图片处理成功")
+            return 0 if success_count == len(results) else 1
+        elif data_output is not None:
+            # 单张图片，输出到标准输出
+            if args.input == '-':
+                data = sys.stdin.buffer.read()
+            elif os.path.isfile(args.input):
+                data = processor.read_file(args.input)
+            else:
+                print("错误: --stdout 只能用于单张图片，多张图片请使用 --tar-stream")
+                return 1
+            
+            outputs = processor.render_bytes(data, auto_date=args.auto_date)
+            if len(outputs) > 1:
+                print(f"警告: 共有 {len(outputs)} 个输出，只输出第一个")
+            data_output.write(outputs[0][1])
+            data_output.flush()
+        elif is_archive(args.input) or (args.output and is_archive(args.output)):
+            # 直接读写压缩包，不解压到磁盘
+            print("开始批量处理...")
+            results = processor.process_archive(args.input, args.output, args.auto_date,
+                                                progress_callback if args.verbose else None,
+                                                workers=args.jobs, queue_depth=args.queue_depth)
+            if not results:
+                print("没有找到支持的图片文件")
+                return
+            
+            success_count = sum(1 for r in results if r['success'])
+            print(f"\n批量处理完成: {success_count}/{len(results)} 张图片处理成功")
+            if args.output and is_archive(args.output):
+                print(f"输出: {args.output}")
+        elif os.path.isfile(args.input):
             # 单张图片
-            output_path = processor.process_image(images[0], None, args.auto_date)
-            print(f"处理完成: {output_path}")
+            images = processor.find_images(args.input)
+            if not images:
+                print("没有找到支持的图片文件")
+                return
+            
+            result = processor.process_image_result(images[0], None, args.auto_date)
+            if 'qualities' in result:
+                qualities = ', '.join(str(quality) for quality in result['qualities'])
+                print(f"处理完成: {result['output']} (质量: {qualities})")
+            else:
+                print(f"处理完成: {result['output']}")
+            if result.get('over_budget'):
+                print(f"警告: {result['output']} 质量降到 1 仍超出大小上限 {args.max_bytes} 字节")
         else:
-            # 批量处理
+            # 批量处理，边遍历目录边处理
             print("开始批量处理...")
+            images = processor.iter_images(args.input, sort=args.sort)
             results = processor.process_batch(images, args.output, args.auto_date, 
-                                            progress_callback if args.verbose else None)
+                                            progress_callback if args.verbose else None,
+                                            jobs=args.jobs, incremental=args.incremental,
+                                            content_hash=args.content_hash,
+                                            journal=processor.journal_path(args.input, args.auto_date),
+                                            resume=args.resume, pipeline=args.pipeline,
+                                            queue_depth=args.queue_depth)
+            
+            if not results:
+                print("没有找到支持的图片文件")
+                return
             
             success_count = sum(1 for r in results if r['success'])
             print(f"\n批量处理完成: {success_count}/{len(results)} 张图片处理成功")
             
+            skipped_count = sum(1 for r in results if r.get('skipped'))
+            if skipped_count:
+                print(f"其中 {skipped_count} 张图片无需处理，已跳过")
+            
+            over_budget = [r for r in results if r.get('over_budget')]
+            if over_budget:
+                print(f"警告: {len(over_budget)} 张图片质量降到 1 仍超出大小上限 {args.max_bytes} 字节")
+                for result in over_budget:
+                    print(f"  ! {result['input']} -> {result['output']}")
+            
             if args.verbose:
                 for result in results:
-                    if result['success']:
+                    if result.get('skipped'):
+                        reason = '已完成' if result['skipped'] == 'resumed' else '未变化'
+                        print(f"  - {result['input']} -> {result['output']} ({reason})")
+                    elif result['success'] and 'qualities' in result:
+                        qualities = ', '.join(str(quality) for quality in result['qualities'])
+                        print(f"  ✓ {result['input']} -> {result['output']} (质量: {qualities})")
+                    elif result['success']:
                         print(f"  ✓ {result['input']} -> {result['output']}")
                     else:
                         print(f"  ✗ {result['input']}: {result['error']}")
@@ -494,4 +2774,6 @@ def main():
     return 0
 
 if __name__ == "__main__":
+    # 打包后的可执行文件使用进程池时需要
+    multiprocessing.freeze_support()
     sys.exit(main())
\ No newline at end of file
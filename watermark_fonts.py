@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+Image Watermarker 字体管理
+扫描系统字体目录生成字体索引（字体族、样式、路径），并缓存已加载的字体
+"""
+
+import os
+import sys
+import json
+from functools import lru_cache
+from pathlib import Path
+from PIL import ImageFont
+
+# 字体索引文件
+FONT_INDEX_FILE = Path.home() / ".watermark_fonts.json"
+FONT_INDEX_VERSION = 1
+
+FONT_EXTENSIONS = {'.ttf', '.otf', '.ttc'}
+
+# 找不到指定字体族时依次尝试的字体族
+FALLBACK_FAMILIES = ['Arial', 'Helvetica', 'DejaVu Sans', 'Liberation Sans', 'Noto Sans']
+
+_font_index = None
+
+
+def get_font_dirs():
+    """获取当前系统的字体目录"""
+    home = Path.home()
+    if sys.platform == 'darwin':
+        dirs = ['/System/Library/Fonts', '/Library/Fonts', home / 'Library/Fonts']
+    elif sys.platform == 'win32':
+        windir = os.environ.get('WINDIR', 'C:/Windows')
+        dirs = [Path(windir) / 'Fonts']
+        if os.environ.get('LOCALAPPDATA'):
+            dirs.append(Path(os.environ['LOCALAPPDATA']) / 'Microsoft/Windows/Fonts')
+    else:
+        dirs = ['/usr/share/fonts', '/usr/local/share/fonts', home / '.fonts', home / '.local/share/fonts']
+
+    return [str(d) for d in dirs if os.path.isdir(d)]
+
+
+def _dir_signature(font_dirs):
+    """字体目录的修改时间，用于判断索引是否过期"""
+    signature = {}
+    for font_dir in font_dirs:
+        try:
+            signature[font_dir] = os.stat(font_dir).st_mtime
+        except OSError:
+            continue
+    return signature
+
+
+def scan_fonts(font_dirs=None):
+    """扫描字体目录，返回字体条目列表"""
+    if font_dirs is None:
+        font_dirs = get_font_dirs()
+
+    fonts = []
+    for font_dir in font_dirs:
+        for root, dirs, files in os.walk(font_dir):
+            for file in files:
+                if Path(file).suffix.lower() not in FONT_EXTENSIONS:
+                    continue
+
+                path = os.path.join(root, file)
+                # .ttc 字体集合中包含多个字体
+                max_faces = 32 if file.lower().endswith('.ttc') else 1
+                for index in range(max_faces):
+                    try:
+                        family, style = ImageFont.truetype(path, 12, index=index).getname()
+                    except Exception:
+                        break
+                    fonts.append({'family': family, 'style': style or 'Regular',
+                                  'path': path, 'index': index})
+
+    return fonts
+
+
+def load_font_index(refresh=False):
+    """加载字体索引，不存在或已过期时重新扫描并保存"""
+    global _font_index
+    if _font_index is not None and not refresh:
+        return _font_index
+
+    font_dirs = get_font_dirs()
+    signature = _dir_signature(font_dirs)
+
+    if not refresh:
+        try:
+            with open(FONT_INDEX_FILE, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') == FONT_INDEX_VERSION and data.get('dirs') == signature:
+                _font_index = data['fonts']
+                return _font_index
+        except Exception:
+            pass
+
+    _font_index = scan_fonts(font_dirs)
+
+    try:
+        data = {'version': FONT_INDEX_VERSION, 'dirs': signature, 'fonts': _font_index}
+        # 先写临时文件再替换，避免多个进程同时写入时留下不完整的索引
+        tmp_file = FONT_INDEX_FILE.with_name(f"{FONT_INDEX_FILE.name}.{os.getpid()}.tmp")
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_file, FONT_INDEX_FILE)
+    except Exception:
+        pass
+
+    return _font_index
+
+
+def list_families():
+    """列出可用的字体族"""
+    return sorted({font['family'] for font in load_font_index()})
+
+
+def _style_score(style, bold, italic):
+    """计算样式与要求的匹配程度，越小越好"""
+    words = style.lower().split()
+    is_bold = any(w in ('bold', 'black', 'heavy', 'semibold', 'demibold') for w in words)
+    is_italic = any(w in ('italic', 'oblique') for w in words)
+
+    score = 0
+    if is_bold != bool(bold):
+        score += 10
+    if is_italic != bool(italic):
+        score += 10
+    # 优先选择常规字重（如 Regular/Book），而不是 Light、Condensed 等变体
+    extra = [w for w in words if w not in ('bold', 'italic', 'oblique', 'regular', 'normal', 'book', 'roman')]
+    return score + len(extra)
+
+
+def find_font(family='Arial', bold=False, italic=False):
+    """按字体族和样式查找字体，返回 (路径, 索引)，找不到时返回 None"""
+    fonts = load_font_index()
+    if not fonts:
+        return None
+
+    for name in [family] + FALLBACK_FAMILIES:
+        if not name:
+            continue
+        candidates = [font for font in fonts if font['family'].lower() == name.lower()]
+        if candidates:
+            best = min(candidates, key=lambda font: _style_score(font['style'], bold, italic))
+            return best['path'], best['index']
+
+    return None
+
+
+@lru_cache(maxsize=32)
+def load_font(path, size, index=0):
+    """加载字体文件，按路径和字号缓存"""
+    return ImageFont.truetype(path, size, index=index)
+
+
+@lru_cache(maxsize=64)
+def get_font(family='Arial', size=36, bold=False, italic=False):
+    """按字体族、字号和样式获取字体"""
+    found = find_font(family, bold, italic)
+    if found:
+        try:
+            return load_font(found[0], size, found[1])
+        except Exception:
+            pass
+
+    # 如果都失败了，使用默认字体
+    try:
+        return ImageFont.load_default(size)
+    except TypeError:
+        # 旧版本Pillow的默认字体不支持指定字号
+        return ImageFont.load_default()
@@ -10,8 +10,9 @@ import tkinter.font as tkFont
 from tkinterdnd2 import DND_FILES, TkinterDnD
 import os
 import json
-from PIL import Image, ImageTk, ImageDraw, ImageFont
-import exifread
+from PIL import Image, ImageTk, ImageDraw
+import watermark_fonts
+from watermark_metadata import get_metadata_cache
 from datetime import datetime
 import threading
 from pathlib import Path
@@ -60,6 +61,9 @@ class WatermarkGUI:
             'resize_percent': 100
         }
         
+        # 图片元数据缓存
+        self.metadata_cache = get_metadata_cache()
+        
         self.setup_ui()
         self.load_default_settings()
         
@@ -322,26 +326,29 @@ class WatermarkGUI:
         for file_path in file_paths:
             if file_path not in [img['path'] for img in self.images]:
                 try:
-                    with Image.open(file_path) as img:
-                        # 获取图片信息
-                        width, height = img.size
-                        format_name = img.format
-                        
-                        image_info = {
-                            'path': file_path,
-                            'filename': os.path.basename(file_path),
-                            'size': f"{width}x{height}",
-                            'format': format_name,
-                            'width': width,
-                            'height': height
-                        }
-                        
-                        self.images.append(image_info)
-                        
-                        # 添加到树形控件
-                        self.file_tree.insert('', 'end', text=image_info['filename'],
-                                            values=(image_info['size'], image_info['format']))
-                        
+                    # 获取图片信息，已缓存的图片不再重新打开
+                    metadata = self.metadata_cache.get_info(file_path)
+                    if metadata is None:
+                        raise IOError("无法识别的图片文件")
+                    
+                    width, height = metadata['width'], metadata['height']
+                    format_name = metadata['format']
+                    
+                    image_info = {
+                        'path': file_path,
+                        'filename': os.path.basename(file_path),
+                        'size': f"{width}x{height}",
+                        'format': format_name,
+                        'width': width,
+                        'height': height
+                    }
+                    
+                    self.images.append(image_info)
+                    
+                    # 添加到树形控件
+                    self.file_tree.insert('', 'end', text=image_info['filename'],
+                                        values=(image_info['size'], image_info['format']))
+                    
                 except Exception as e:
                     print(f"无法加载图片 {file_path}: {e}")
         
@@ -380,14 +387,9 @@ class WatermarkGUI:
     
     def get_exif_date(self, image_path):
         """从EXIF数据获取日期"""
-        try:
-            with open(image_path, 'rb') as f:
-                tags = exifread.process_file(f)
-                if 'EXIF DateTimeOriginal' in tags:
-                    date_str = str(tags['EXIF DateTimeOriginal'])
-                    return date_str.split(' ')[0].replace(':', '-')
-        except:
-            pass
+        metadata = self.metadata_cache.get_info(image_path)
+        if metadata and metadata['date']:
+            return metadata['date']
         
         # 如果没有EXIF日期，使用当前日期
         return datetime.now().strftime("%Y-%m-%d")
@@ -483,14 +485,10 @@ class WatermarkGUI:
             draw = ImageDraw.Draw(img_with_watermark)
         
         # 设置字体
-        try:
-            font = ImageFont.truetype("arial.ttf", self.watermark_settings['font_size'])
-        except:
-            try:
-                # macOS系统字体
-                font = ImageFont.truetype("/System/Library/Fonts/Arial.ttf", self.watermark_settings['font_size'])
-            except:
-                font = ImageFont.load_default()
+        font = watermark_fonts.get_font(self.watermark_settings.get('font_family', 'Arial'),
+                                        self.watermark_settings['font_size'],
+                                        self.watermark_settings.get('bold', False),
+                                        self.watermark_settings.get('italic', False))
         
         # 获取文本尺寸
         text = self.watermark_settings['text']
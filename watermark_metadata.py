@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+Image Watermarker 元数据缓存
+将图片的EXIF拍摄日期、尺寸、模式和格式保存在SQLite数据库中，
+以路径、文件大小和修改时间为键，文件变化后缓存自动失效
+"""
+
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from PIL import Image
+import exifread
+
+# 元数据缓存数据库
+METADATA_CACHE_FILE = Path.home() / ".watermark_metadata.db"
+
+# EXIF DateTimeOriginal 标签及其所在的 Exif 子IFD
+EXIF_DATETIME_ORIGINAL = 36867
+EXIF_IFD = 0x8769
+
+METADATA_FIELDS = ('date', 'width', 'height', 'mode', 'format')
+
+
+def format_exif_date(date_str):
+    """将 EXIF 日期 '2024:05:01 10:00:00' 转换为 '2024-05-01'"""
+    return str(date_str).split(' ')[0].replace(':', '-')
+
+
+def read_exif_date(image=None, fp=None):
+    """读取EXIF拍摄日期，优先使用已打开的图片，其次用exifread解析 fp，没有时返回 None"""
+    if image is not None:
+        try:
+            date_str = image.getexif().get_ifd(EXIF_IFD).get(EXIF_DATETIME_ORIGINAL)
+            if date_str:
+                return format_exif_date(date_str)
+        except:
+            pass
+
+    if fp is not None:
+        try:
+            # 读到 DateTimeOriginal 即停止
+            tags = exifread.process_file(fp, stop_tag='DateTimeOriginal', details=False)
+            if 'EXIF DateTimeOriginal' in tags:
+                return format_exif_date(tags['EXIF DateTimeOriginal'])
+        except:
+            pass
+
+    return None
+
+
+def image_metadata(image, date=None):
+    """从已打开的图片收集元数据"""
+    return {
+        'date': date,
+        'width': image.width,
+        'height': image.height,
+        'mode': image.mode,
+        'format': image.format
+    }
+
+
+def read_image_metadata(image_path):
+    """读取图片元数据（只解析文件头，不解码像素）"""
+    with open(image_path, 'rb') as f:
+        with Image.open(f) as img:
+            date = read_exif_date(img)
+            if date is None:
+                f.seek(0)
+                date = read_exif_date(fp=f)
+            return image_metadata(img, date)
+
+
+class MetadataCache:
+    """基于SQLite的图片元数据缓存"""
+
+    def __init__(self, db_path=None):
+        self.db_path = str(db_path or METADATA_CACHE_FILE)
+        self.enabled = True
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        """获取数据库连接，进程池子进程中会重新连接"""
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            # WAL模式允许多个进程同时读写
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('''CREATE TABLE IF NOT EXISTS metadata (
+                                path TEXT PRIMARY KEY,
+                                size INTEGER,
+                                mtime_ns INTEGER,
+                                date TEXT,
+                                width INTEGER,
+                                height INTEGER,
+                                mode TEXT,
+                                format TEXT)''')
+            conn.commit()
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def _file_key(self, image_path):
+        st = os.stat(image_path)
+        return os.path.abspath(image_path), st.st_size, st.st_mtime_ns
+
+    def lookup(self, image_path):
+        """查找缓存的元数据，文件不存在、已修改或未缓存时返回 None"""
+        if not self.enabled:
+            return None
+        try:
+            key = self._file_key(image_path)
+            with self._lock:
+                row = self._connect().execute(
+                    'SELECT date, width, height, mode, format FROM metadata '
+                    'WHERE path = ? AND size = ? AND mtime_ns = ?', key).fetchone()
+        except (OSError, sqlite3.Error):
+            self._disable_on_db_error()
+            return None
+
+        return dict(zip(METADATA_FIELDS, row)) if row else None
+
+    def store(self, image_path, metadata):
+        """保存元数据，覆盖该路径的旧记录"""
+        if not self.enabled:
+            return
+        try:
+            key = self._file_key(image_path)
+            values = key + tuple(metadata.get(field) for field in METADATA_FIELDS)
+            with self._lock:
+                conn = self._connect()
+                conn.execute('INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, ?, ?, ?)', values)
+                conn.commit()
+        except (OSError, sqlite3.Error):
+            self._disable_on_db_error()
+
+    def get_info(self, image_path):
+        """获取元数据，未缓存时读取文件头并写入缓存；无法读取时返回 None"""
+        metadata = self.lookup(image_path)
+        if metadata is not None:
+            return metadata
+
+        try:
+            metadata = read_image_metadata(image_path)
+        except Exception:
+            return None
+
+        self.store(image_path, metadata)
+        return metadata
+
+    def _disable_on_db_error(self):
+        """数据库无法使用时（如主目录只读）停用缓存"""
+        try:
+            self._connect()
+        except (OSError, sqlite3.Error):
+            self.enabled = False
+
+
+_default_cache = None
+
+
+def get_metadata_cache():
+    """获取默认的元数据缓存"""
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = MetadataCache()
+    return _default_cache
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+Image Watermarker 分块TIFF处理
+直接读写分块（tiled）TIFF文件第一页的图块：只解码、修改并重新编码与水印重叠的图块，
+其余图块原样复制，内存占用只与图块大小有关，与图片大小无关
+"""
+
+import os
+import shutil
+import struct
+import zlib
+from PIL import Image
+
+# TIFF标签
+TAG_IMAGE_WIDTH = 256
+TAG_IMAGE_LENGTH = 257
+TAG_BITS_PER_SAMPLE = 258
+TAG_COMPRESSION = 259
+TAG_PHOTOMETRIC = 262
+TAG_ORIENTATION = 274
+TAG_SAMPLES_PER_PIXEL = 277
+TAG_PLANAR_CONFIG = 284
+TAG_PREDICTOR = 317
+TAG_TILE_WIDTH = 322
+TAG_TILE_LENGTH = 323
+TAG_TILE_OFFSETS = 324
+TAG_TILE_BYTE_COUNTS = 325
+TAG_EXTRA_SAMPLES = 338
+
+# 整数类型：SHORT、LONG、LONG8
+FIELD_TYPES = {3: ('H', 2), 4: ('L', 4), 16: ('Q', 8)}
+
+# 支持的压缩方式：无压缩、Deflate（Adobe Deflate）
+COMPRESSION_NONE = 1
+COMPRESSION_DEFLATE = (8, 32946)
+
+
+class TileLayout:
+    """分块TIFF第一页的图块布局"""
+
+    def __init__(self, byte_order, size, tile_size, mode, compression, offsets, byte_counts,
+                 offsets_field, byte_counts_field, orientation=1):
+        self.byte_order = byte_order
+        self.size = size
+        self.tile_size = tile_size
+        self.mode = mode
+        self.compression = compression
+        self.offsets = offsets
+        self.byte_counts = byte_counts
+        # (字段类型, 数组在文件中的位置)，用于更新图块的位置和大小
+        self.offsets_field = offsets_field
+        self.byte_counts_field = byte_counts_field
+        # TIFF方向标签，与EXIF方向的取值相同
+        self.orientation = orientation
+        self.tiles_across = -(-size[0] // tile_size[0])
+
+    def tile_origin(self, index):
+        """图块左上角在图片中的坐标"""
+        row, column = divmod(index, self.tiles_across)
+        return column * self.tile_size[0], row * self.tile_size[1]
+
+    def tiles_in_box(self, box):
+        """与 box (left, top, right, bottom) 重叠的图块索引"""
+        left, top = max(box[0], 0), max(box[1], 0)
+        right, bottom = min(box[2], self.size[0]), min(box[3], self.size[1])
+        if left >= right or top >= bottom:
+            return []
+
+        tile_width, tile_height = self.tile_size
+        return [row * self.tiles_across + column
+                for row in range(top // tile_height, (bottom - 1) // tile_height + 1)
+                for column in range(left // tile_width, (right - 1) // tile_width + 1)]
+
+
+def _read_values(f, byte_order, field):
+    """读取一个标签的整数值列表"""
+    field_type, count, position = field
+    fmt, size = FIELD_TYPES[field_type]
+    f.seek(position)
+    return list(struct.unpack(f"{byte_order}{count}{fmt}", f.read(count * size)))
+
+
+def read_tile_layout(path):
+    """解析TIFF第一页的图块布局
+
+    不是分块TIFF，或者不支持其像素格式（8位 L/RGB/RGBA、按像素交错存储）
+    或压缩方式（无压缩、不带预测器的Deflate）时返回 None。
+    """
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(16)
+            if header[:2] == b'II':
+                byte_order = '<'
+            elif header[:2] == b'MM':
+                byte_order = '>'
+            else:
+                return None
+
+            magic = struct.unpack(byte_order + 'H', header[2:4])[0]
+            if magic == 42:
+                big = False
+                ifd_offset = struct.unpack(byte_order + 'L', header[4:8])[0]
+            elif magic == 43:
+                big = True
+                ifd_offset = struct.unpack(byte_order + 'Q', header[8:16])[0]
+            else:
+                return None
+
+            # BigTIFF 的条目更长，条目内可直接存放的数据也更多
+            count_format, count_size = ('Q', 8) if big else ('H', 2)
+            entry_size, inline_size = (20, 8) if big else (12, 4)
+            value_format = 'Q' if big else 'L'
+
+            f.seek(ifd_offset)
+            entry_count = struct.unpack(byte_order + count_format, f.read(count_size))[0]
+            entries = f.read(entry_count * entry_size)
+
+            fields = {}
+            for i in range(entry_count):
+                entry = entries[i * entry_size:(i + 1) * entry_size]
+                tag, field_type = struct.unpack(byte_order + 'HH', entry[:4])
+                if field_type not in FIELD_TYPES:
+                    continue
+                count = struct.unpack(byte_order + value_format, entry[4:4 + inline_size])[0]
+                position = ifd_offset + count_size + i * entry_size + 4 + inline_size
+                if count * FIELD_TYPES[field_type][1] > inline_size:
+                    position = struct.unpack(byte_order + value_format, entry[4 + inline_size:])[0]
+                fields[tag] = (field_type, count, position)
+
+            def value(tag, default=None):
+                if tag not in fields:
+                    return default
+                return _read_values(f, byte_order, fields[tag])[0]
+
+            if TAG_TILE_WIDTH not in fields or TAG_TILE_OFFSETS not in fields:
+                return None
+
+            compression = value(TAG_COMPRESSION, COMPRESSION_NONE)
+            if compression != COMPRESSION_NONE and compression not in COMPRESSION_DEFLATE:
+                return None
+            if value(TAG_PREDICTOR, 1) != 1 or value(TAG_PLANAR_CONFIG, 1) != 1:
+                return None
+
+            samples = value(TAG_SAMPLES_PER_PIXEL, 1)
+            if fields.get(TAG_BITS_PER_SAMPLE) is None or \
+                    set(_read_values(f, byte_order, fields[TAG_BITS_PER_SAMPLE])) != {8}:
+                return None
+
+            photometric = value(TAG_PHOTOMETRIC)
+            if samples == 1 and photometric == 1:
+                mode = 'L'
+            elif samples == 3 and photometric == 2:
+                mode = 'RGB'
+            elif samples == 4 and photometric == 2 and value(TAG_EXTRA_SAMPLES) == 2:
+                # 只支持非预乘的透明通道
+                mode = 'RGBA'
+            else:
+                return None
+
+            return TileLayout(
+                byte_order,
+                (value(TAG_IMAGE_WIDTH), value(TAG_IMAGE_LENGTH)),
+                (value(TAG_TILE_WIDTH), value(TAG_TILE_LENGTH)),
+                mode,
+                compression,
+                _read_values(f, byte_order, fields[TAG_TILE_OFFSETS]),
+                _read_values(f, byte_order, fields[TAG_TILE_BYTE_COUNTS]),
+                fields[TAG_TILE_OFFSETS][::2],
+                fields[TAG_TILE_BYTE_COUNTS][::2],
+                value(TAG_ORIENTATION, 1)
+            )
+    except (OSError, struct.error, KeyError, IndexError):
+        return None
+
+
+def read_tile(f, layout, index):
+    """读取并解码一个图块"""
+    f.seek(layout.offsets[index])
+    data = f.read(layout.byte_counts[index])
+    if layout.compression != COMPRESSION_NONE:
+        data = zlib.decompress(data)
+    return Image.frombytes(layout.mode, layout.tile_size, data)
+
+
+def encode_tile(layout, tile):
+    """按原压缩方式编码图块"""
+    data = tile.tobytes()
+    if layout.compression != COMPRESSION_NONE:
+        data = zlib.compress(data)
+    return data
+
+
+def _write_value(f, layout, field, index, value):
+    """更新图块位置或大小数组中的一项"""
+    field_type, position = field
+    fmt, size = FIELD_TYPES[field_type]
+    if value >= 1 << (size * 8):
+        raise ValueError("图块位置或大小超出TIFF字段的范围")
+    f.seek(position + index * size)
+    f.write(struct.pack(layout.byte_order + fmt, value))
+
+
+def rewrite_tiles(input_path, output_path, layout, indices, modify):
+    """复制TIFF文件，并用 modify(索引, 图块图片) 返回的图片替换 indices 中的图块
+
+    其余图块原样复制；新图块不大于原图块时原位写入，否则追加到文件末尾并更新图块位置。
+    """
+    shutil.copyfile(input_path, output_path)
+
+    with open(input_path, 'rb') as source, open(output_path, 'r+b') as target:
+        for index in indices:
+            data = encode_tile(layout, modify(index, read_tile(source, layout, index)))
+
+            if len(data) <= layout.byte_counts[index]:
+                offset = layout.offsets[index]
+            else:
+                target.seek(0, os.SEEK_END)
+                # 数据按字对齐
+                if target.tell() % 2:
+                    target.write(b'\0')
+                offset = target.tell()
+
+            target.seek(offset)
+            target.write(data)
+            _write_value(target, layout, layout.offsets_field, index, offset)
+            _write_value(target, layout, layout.byte_counts_field, index, len(data))
+        
+        # 写入完成后刷到磁盘，再由调用方替换目标文件
+        target.flush()
+        os.fsync(target.fileno())